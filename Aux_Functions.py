@@ -1013,6 +1013,10 @@ def GetListDataset(list_name):
                     'W(#phi)',
                     'd#sigma/d#phi [pb]',
                     'd#sigma/d#phi [events]'),
+     'WBosonPt_1': ('W Boson pT',
+                    'p_{T} [GeV]',
+                    'd#sigma/dp_{T} [pb/GeV]',
+                    'd#sigma/dp_{T} [events/GeV]'),
      'WBosonPt_OLV_1': ('W Boson pT - OLV',
                     'p_{T} [GeV]',
                     'd#sigma/dp_{T} [pb/GeV]',
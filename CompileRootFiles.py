@@ -6,8 +6,6 @@ from Aux_Functions import *
 # from pyAMI.query import *
 # from pyAMI.exceptions import *
 
-hf = ROOT.TFile("VBF_Systematics.root", "RECREATE")
-
 datasets = GetListDataset('datasets')
 dataset_names = GetListDataset('dataset_names')
 exp_hist_list = GetListDataset('exp_hist_list')
@@ -78,6 +76,95 @@ def CompileDijetMass(ExclMjj,th2_hist):
         
     return th2_hist
 
+def GetHistogram(source, name):
+    # source is an open ROOT file or a dict of histograms built in memory
+    # (see AidaToTH1s in aidamerge.py). Returns None if name is not in it.
+    if isinstance(source, dict): return source.get(name)
+    if not source.GetListOfKeys().Contains(name): return None
+    return source.Get(name)
+
+def CompileDataset(hf, h_xsecs, idx, folder, source, source_add):
+    # Write the histograms of one dataset into its directory of hf, styled,
+    # normalized to the cross-section in Normalized_XS and combined into the
+    # Mjj vs N_jets TH2s. source and source_add hold the averaged and the
+    # added histograms (see GetHistogram).
+    th2_hist_30 = ROOT.TH2F( "hmj1j2_wvbf", "hmj1j2_wvbf", 10, -0.5, 9.5, 200, 0, 5000 )
+    th2_hist_20 = ROOT.TH2F( "hmj1j2_wvbf_20", "hmj1j2_wvbf_20", 10, -0.5, 9.5, 200, 0, 5000 )
+    # First get the crossSection_mean and GenFiltEff_mean for this dataset from AMI for normalizations
+    xsec = cross_sections[idx][0]
+    #effic = cross_sections[idx][1] # Do not use efficiency for MjjFilt datasets
+    h_xsecs.Fill(idx,xsec)
+    print folder, xsec
+
+    # histogram manipulation and such
+    hf.mkdir(folder)
+    hf.cd(folder)
+    ROOT.gDirectory.mkdir("Normalized_XS")
+    file_name = folder.split('.')
+    file_name = file_name[0]
+    h_xsecs.GetXaxis().SetBinLabel(idx+1,file_name)
+    for index, hist in enumerate(hist_list):
+        if index > len(title_list)-1: index = index-len(title_list)
+        # No normalization
+        histogram = GetHistogram(source, hist)
+        if histogram is None: continue
+        histogram_add = GetHistogram(source_add, hist)
+        hf.cd(folder)
+        StyleHistogram(index, histogram)
+        if "CutFlow" in hist:
+            StyleCutFlow(histogram_add) # Labels the Cut Flow histograms
+            histogram_add.Write()
+        elif "RegionPop" in hist:
+            StyleRegPop(histogram_add)
+            histogram_add.Write()
+        else:
+            histogram.Write()
+        # Clone root histograms, normalize to XS, and move to Normalized_XS directory
+        histogram_norm = histogram.Clone(hist+"_norm")
+        histogram_norm.GetYaxis().SetTitle("(1/#sigma) "+y_axis_list_norm[index])
+        histogram_norm.Scale(1.0/xsec)
+        ROOT.gDirectory.cd("Normalized_XS")
+        histogram_norm.Write()
+        ROOT.gDirectory.cd()
+        if "Mjj_" in hist and "Jet_1" in hist:
+            th2_hist_30 = CompileDijetMass(histogram_norm,th2_hist_30)
+        if "Mjj_" in hist and "Jet_2" in hist:
+            th2_hist_20 = CompileDijetMass(histogram_norm,th2_hist_20)
+        del histogram_norm
+    hf.cd(folder)
+    StyleTH2(th2_hist_30)
+    StyleTH2(th2_hist_20)
+    th2_hist_30.Write()
+    th2_hist_20.Write()
+    del th2_hist_30, th2_hist_20
+    hf.cd()
+
+def OpenCompiledFile(filename = "VBF_Systematics.root"):
+    # Create the output file with the experimental data and return it
+    # together with the (still empty) cross-section histogram
+    hf = ROOT.TFile(filename, "RECREATE")
+    if os.path.exists("Exp_Data_arXiv12011276.root") == True:
+        hf.mkdir("Exp_Data_2012")
+        hf.cd("Exp_Data_2012")
+        exp_data = ROOT.TFile.Open("Exp_Data_arXiv12011276.root")
+        for index, hist in enumerate(exp_hist_list):
+            histogram = exp_data.Get(hist)
+            hf.cd("Exp_Data_2012")
+            StyleData(index, histogram)
+            histogram.Write()
+            del histogram
+        exp_data.Close()
+        hf.cd()
+    h_xsecs = ROOT.TH1F("Cross_Sections","Cross_Sections",len(dataset_names),0,len(dataset_names))
+    h_xsecs.GetYaxis().SetTitle("Cross Section [pb]")
+    return hf, h_xsecs
+
+def CloseCompiledFile(hf, h_xsecs):
+    hf.cd()
+    h_xsecs.Write()
+    hf.Write()
+    hf.Close()
+
 #Setup AMIClient.	
 #This works only on my laptop, otherwise you need to run 'ami auth'
 # client = AMIClient()
@@ -85,86 +172,22 @@ def CompileDijetMass(ExclMjj,th2_hist):
 #     create_auth_config()
 # client.read_config(AMI_CONFIG)
 
-if os.path.exists("Exp_Data_arXiv12011276.root") == True:
-	hf.mkdir("Exp_Data_2012")
-	hf.cd("Exp_Data_2012")
-	exp_data = ROOT.TFile.Open("Exp_Data_arXiv12011276.root")
-	for index, hist in enumerate(exp_hist_list):
-		histogram = exp_data.Get(hist)
-		hf.cd("Exp_Data_2012")
-		StyleData(index, histogram)
-		histogram.Write()
-		del histogram
-	exp_data.Close()
-	hf.cd()
-
-# Folder names must be the same as in the dataset_names list in Aux_Functions.py
-# I could try to get the script to just to check for run number in folder name (do this later)
-# Root file needs to be named after the dataset run number
-_h_xsecs = ROOT.TH1F("Cross_Sections","Cross_Sections",len(dataset_names),0,len(dataset_names))
-_h_xsecs.GetYaxis().SetTitle("Cross Section [pb]")
-for idx,folder in enumerate(dataset_names):
-#for folder, data in zip(dataset_names, datasets):
-    if os.path.exists(folder+"/") == True: # and not os.listdir("./"+folder+"/"):
-        th2_hist_30 = ROOT.TH2F( "hmj1j2_wvbf", "hmj1j2_wvbf", 10, -0.5, 9.5, 200, 0, 5000 )
-        th2_hist_20 = ROOT.TH2F( "hmj1j2_wvbf_20", "hmj1j2_wvbf_20", 10, -0.5, 9.5, 200, 0, 5000 )
-        # First get the crossSection_mean and GenFiltEff_mean for this dataset from AMI for normalizations
-        xsec = cross_sections[idx][0]
-        #effic = cross_sections[idx][1] # Do not use efficiency for MjjFilt datasets
-        _h_xsecs.Fill(idx,xsec)
-        print folder, xsec
+if __name__ == '__main__':
+    hf, _h_xsecs = OpenCompiledFile()
 
-        # histogram manipulation and such
-        os.chdir(folder+"/")
-        hf.mkdir(folder)
-        hf.cd(folder)
-        ROOT.gDirectory.mkdir("Normalized_XS")
-        file_name = folder.split('.')
-        file_name = file_name[0]
-        _h_xsecs.GetXaxis().SetBinLabel(idx+1,file_name)
-        root_file = ROOT.TFile.Open(file_name+".root")
-        root_file_add = ROOT.TFile.Open(file_name+"_add.root")
-        for index, hist in enumerate(hist_list):
-            if index > len(title_list)-1: index = index-len(title_list)
-            # No normalization
-            if not root_file.GetListOfKeys().Contains(hist): continue
-            histogram = root_file.Get(hist)
-            histogram_add = root_file_add.Get(hist)
-            hf.cd(folder)
-            StyleHistogram(index, histogram)
-            if "CutFlow" in hist:
-                StyleCutFlow(histogram_add) # Labels the Cut Flow histograms
-                histogram_add.Write()
-            elif "RegionPop" in hist:
-                StyleRegPop(histogram_add)
-                histogram_add.Write()
-            else:
-                histogram.Write()
-            # Clone root histograms, normalize to XS, and move to Normalized_XS directory
-            histogram_norm = histogram.Clone(hist+"_norm")
-            histogram_norm.GetYaxis().SetTitle("(1/#sigma) "+y_axis_list_norm[index])
-            histogram_norm.Scale(1.0/xsec)
-            ROOT.gDirectory.cd("Normalized_XS")
-            histogram_norm.Write()
-            ROOT.gDirectory.cd()
-            if "Mjj_" in hist and "Jet_1" in hist:
-                th2_hist_30 = CompileDijetMass(histogram_norm,th2_hist_30)
-            if "Mjj_" in hist and "Jet_2" in hist:
-                th2_hist_20 = CompileDijetMass(histogram_norm,th2_hist_20)
-            del histogram_norm
-        hf.cd(folder)
-        StyleTH2(th2_hist_30)
-        StyleTH2(th2_hist_20)
-        th2_hist_30.Write()
-        th2_hist_20.Write()
-        del th2_hist_30, th2_hist_20
-        root_file.Close()
-        hf.cd()
-        os.chdir("..")
-    else:
-    	continue
+    # Folder names must be the same as in the dataset_names list in Aux_Functions.py
+    # I could try to get the script to just to check for run number in folder name (do this later)
+    # Root file needs to be named after the dataset run number
+    for idx,folder in enumerate(dataset_names):
+    #for folder, data in zip(dataset_names, datasets):
+        if os.path.exists(folder+"/") == True: # and not os.listdir("./"+folder+"/"):
+            file_name = folder.split('.')[0]
+            root_file = ROOT.TFile.Open(folder+"/"+file_name+".root")
+            root_file_add = ROOT.TFile.Open(folder+"/"+file_name+"_add.root")
+            CompileDataset(hf, _h_xsecs, idx, folder, root_file, root_file_add)
+            root_file.Close()
+        else:
+            continue
 
-_h_xsecs.Write()
-hf.Write()
-hf.Close()
-print "Job Complete!!!"
+    CloseCompiledFile(hf, _h_xsecs)
+    print "Job Complete!!!"
@@ -1,12 +1,29 @@
 import glob
+from optparse import OptionParser
+from multiprocessing import cpu_count
+from LHE_Functions import CountEvents, RunParallel
 
-total = []
-for file in glob.glob('./*.lhe'):
-  num = 0
-  with open(file) as f:
-    for line in f:
-      if '<event>' in line: num += 1
-  total.append(num)
-  print file+" has "+str(num)+" events in it."
-  
-print "Total number of events in given files: %i" % sum(total)
\ No newline at end of file
+parser = OptionParser(usage="%prog [options] [file.lhe file.lhe.gz file.tar.gz ...] (default is all *.lhe files)")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files counted in parallel (default is the number of cores).")
+(options, args) = parser.parse_args()
+
+# The count for plain files comes from the .idx sidecar, which is only rebuilt
+# when the LHE file has changed since it was indexed. With fewer files than
+# jobs the files are taken one after the other and the index of each one is
+# built by all workers over byte ranges of the file instead.
+filenames = args if args else glob.glob('./*.lhe')
+
+def countInFile(file):
+  return CountEvents(file, options.jobs)
+
+if __name__ == '__main__':
+  total = []
+  if len(filenames) < options.jobs:
+    results = RunParallel(countInFile, filenames, 1)
+  else:
+    results = RunParallel(CountEvents, filenames, options.jobs)
+  for file, num in results:
+    total.append(num)
+    print file+" has "+str(num)+" events in it."
+    
+  print "Total number of events in given files: %i" % sum(total)
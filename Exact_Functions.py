@@ -0,0 +1,40 @@
+import operator
+import numpy as np
+
+# Exact sums of float64 values, shared by the cross-section accumulation in
+# LHE_Functions.py and the AIDA merging in aidamerge.py. The sums are kept
+# as Python integers, so adding partial sums in any grouping gives the same
+# result as one pass over all values.
+
+EXACT_SCALE = 1200	# exact sums are integers in units of 2**-EXACT_SCALE
+
+def ExactColumnSums(values):
+    # Exact sum of every column of a 2-D float64 array as Python integers in
+    # units of 2**-EXACT_SCALE. Every value is split into an integer
+    # mantissa and a power of two, and the mantissas are summed separately
+    # for every (column, exponent) pair. The 53-bit mantissa is cut into two
+    # halves of at most 27 bits, so the float64 bincount sums stay exact for
+    # blocks of up to 2**26 rows.
+    nrows, ncols = values.shape
+    if nrows == 0: return [0]*ncols
+    mantissa, exponent = np.frexp(values)
+    m = (mantissa*2.0**53).astype(np.int64)
+    hi = m >> 26
+    lo = m - (hi << 26)
+    exponent = exponent.astype(np.int64)
+    emin = int(exponent.min())
+    key = ((exponent-emin)*ncols + np.arange(ncols)[None,:]).ravel()
+    sum_hi = np.bincount(key, weights=hi.ravel().astype(np.float64))
+    sum_lo = np.bincount(key, weights=lo.ravel().astype(np.float64))
+    sums = [0]*ncols
+    for k in np.nonzero((sum_hi != 0) | (sum_lo != 0))[0]:
+        shift = int(k//ncols) + emin - 53 + EXACT_SCALE
+        sums[k % ncols] += ((int(sum_hi[k]) << 26) + int(sum_lo[k])) << shift
+    return sums
+
+def ExactToFloat(value):
+    # Correctly rounded float of an exact sum, +-inf beyond the float range
+    try:
+        return operator.truediv(value, 1 << EXACT_SCALE)
+    except OverflowError:
+        return float('inf') if value > 0 else -float('inf')
@@ -0,0 +1,1663 @@
+import os, re, sys, zlib, json, mmap, array, gzip, shutil, hashlib, tarfile, itertools, threading
+import numpy as np
+from Parallel_Functions import RunParallel
+from Exact_Functions import ExactColumnSums, ExactToFloat
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+# Shared helpers for the LHE scripts (mergeLHE.py, splitLHE.py, calc_XS.py,
+# Count_Events_LHEF.py, changeEventWeight.py, scalup.py, lhe2root.py, ...).
+# Files are scanned in large binary chunks and an event is only split into
+# fields when one of its fields is actually asked for.
+
+CHUNK_SIZE = 1 << 22	# 4 MB reads
+
+#--------------Compressed input/output--------------------------------------
+GZIP_LEVEL = 6
+LHE_EXTENSIONS = ('.lhe', '.events')
+
+class ThreadedReader( object ):
+
+    ##
+    # @short Read-ahead wrapper that decompresses in a background thread
+    #
+    # A thread keeps up to depth chunks of the wrapped (decompressing) file in
+    # a queue, so decompression overlaps with parsing in the main thread. zlib
+    # releases the GIL while it works. read() returns at most size bytes and
+    # an empty string only at the end of the stream.
+    def __init__( self, fileobj, closers = (), chunk_size = CHUNK_SIZE, depth = 4 ):
+        self._file = fileobj
+        self._closers = closers
+        self._chunk_size = chunk_size
+        self._queue = Queue(depth)
+        self._pending = b''
+        self._done = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run( self ):
+        try:
+            while not self._closing:
+                data = self._file.read(self._chunk_size)
+                self._queue.put(data)
+                if not data: break
+        except Exception as e:
+            self._queue.put(e)
+
+    def _next( self ):
+        item = self._queue.get()
+        if isinstance(item, Exception): raise item
+        if not item: self._done = True
+        return item
+
+    def read( self, size = -1 ):
+        if size < 0:
+            chunks = [self._pending]
+            while not self._done:
+                chunks.append(self._next())
+            self._pending = b''
+            return b''.join(chunks)
+        if not self._pending and not self._done:
+            self._pending = self._next()
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+    def close( self ):
+        # Unblock the thread if it is waiting on a full queue, then clean up
+        self._closing = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                self._thread.join(0.1)
+        for closer in self._closers:
+            closer.close()
+
+def IsCompressed(filename):
+    return filename.endswith('.gz') or filename.endswith('.tgz')
+
+def LHEBaseName(filename):
+    # a/b.lhe, a/b.events.gz and a/b.tar.gz all give "b"
+    name = os.path.basename(filename)
+    for ext in ('.gz', '.tgz', '.tar'):
+        if name.endswith(ext): name = name[:-len(ext)]
+    for ext in LHE_EXTENSIONS:
+        if name.endswith(ext): name = name[:-len(ext)]
+    return name
+
+def OpenLHE(filename, chunk_size = CHUNK_SIZE):
+    # Open an LHE file for binary reading. .lhe.gz/.events.gz are gunzipped
+    # and for .tar.gz/.tgz the first .lhe or .events member (or else the first
+    # regular file) is streamed straight out of the tarball, both without
+    # extracting anything to disk.
+    if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+        tar = tarfile.open(filename, 'r|gz')
+        members = []
+        for member in tar:
+            if not member.isfile(): continue
+            members.append(member)
+            if member.name.endswith(LHE_EXTENSIONS): break
+        else:
+            # Stream mode cannot go back to an earlier member
+            tar.close()
+            if not members: raise IOError("No LHE file found in {0}".format(filename))
+            tar = tarfile.open(filename, 'r|gz')
+            for member in tar:
+                if member.isfile(): break
+        return ThreadedReader(tar.extractfile(member), (tar,), chunk_size)
+    if filename.endswith('.gz'):
+        gz = gzip.open(filename, 'rb')
+        return ThreadedReader(gz, (gz,), chunk_size)
+    return open(filename, 'rb')
+
+def OpenLHEOutput(filename, compress = False):
+    # Open an output LHE file, gzipped (with .gz appended) if compress is set
+    if compress:
+        if not filename.endswith('.gz'): filename += '.gz'
+        return gzip.open(filename, 'wb', GZIP_LEVEL)
+    return open(filename, 'wb')
+
+#--------------Event record-------------------------------------------------
+class LHEEvent( object ):
+
+    ##
+    # @short One <event> ... </event> block of an LHE file
+    #
+    # text holds the raw block (whole lines, from the <event> line up to and
+    # including the </event> line) and offset is its byte position in the
+    # input file. Everything else is parsed lazily and cached.
+    __slots__ = ('text', 'offset', '_lines', '_info')
+
+    def __init__( self, text, offset = -1 ):
+        self.text = text
+        self.offset = offset
+        self._lines = None
+        self._info = None
+
+    @property
+    def lines( self ):
+        # Raw lines (with newlines), lines[0] is the <event> line
+        if self._lines is None: self._lines = self.text.splitlines(True)
+        return self._lines
+
+    def setLine( self, i, line ):
+        # Replace one line of the event (the text is rebuilt by write())
+        self.lines[i] = line
+        if i == 1: self._info = None
+
+    def write( self, outfile ):
+        if self._lines is None: outfile.write(self.text)
+        else:                   outfile.write(b''.join(self._lines))
+
+    @property
+    def info( self ):
+        # Split event info line: NUP IDPRUP XWGTUP SCALUP AQEDUP AQCDUP
+        if self._info is None: self._info = self.lines[1].split()
+        return self._info
+
+    @property
+    def nparticles( self ):
+        return int(self.info[0])
+
+    @property
+    def weight( self ):
+        return float(self.info[2])
+
+    @property
+    def scale( self ):
+        return float(self.info[3])
+
+    @property
+    def particle_lines( self ):
+        return self.lines[2:2+self.nparticles]
+
+    @property
+    def particles( self ):
+        # IDUP ISTUP MOTHUP(2) ICOLUP(2) PUP(5) VTIMUP SPINUP for each particle
+        return [line.split() for line in self.particle_lines]
+
+    @property
+    def comment_lines( self ):
+        # Everything between the last particle and </event> (#rwgt, #new, ...)
+        return self.lines[2+self.nparticles:-1]
+
+    @property
+    def new_weights( self ):
+        # Powheg reweighting: "#new weight,renfact,facfact,pdf1,pdf2 w ren fac ..."
+        return [float(line.split()[2]) for line in self.comment_lines if line.startswith(b'#new')]
+
+#--------------Init block--------------------------------------------------
+class LHEInit( object ):
+
+    ##
+    # @short Parsed <init> block
+    #
+    # beams is the split beam line (IDBMUP(2) EBMUP(2) PDFGUP(2) PDFSUP(2)
+    # IDWTUP NPRUP) and processes holds [XSECUP, XERRUP, XMAXUP, LPRUP] for
+    # each process line. Any other lines in the block are kept as they are.
+    def __init__( self, text ):
+        self.lines = text.splitlines(True)
+        self._beam_line = None
+        self._process_lines = []
+        for i, line in enumerate(self.lines):
+            fields = line.split()
+            if not fields or line.lstrip().startswith((b'<', b'#')): continue
+            if self._beam_line is None:
+                self._beam_line = i
+                self.beams = fields
+                nprup = int(fields[9])
+            elif len(self._process_lines) < nprup:
+                self._process_lines.append(i)
+        self.processes = []
+        for i in self._process_lines:
+            fields = self.lines[i].split()
+            self.processes.append([float(fields[0]), float(fields[1]), float(fields[2]), int(fields[3])])
+
+    def isCompatible( self, other ):
+        # Same beams, PDFs, weighting strategy and process IDs
+        return ( self.beams == other.beams and
+                 [p[3] for p in self.processes] == [p[3] for p in other.processes] )
+
+    def text( self ):
+        # The <init> block with the current values of processes written back
+        lines = list(self.lines)
+        for i, process in zip(self._process_lines, self.processes):
+            lines[i] = ('  %.5E %.5E  %.5E  %d\n' % tuple(process)).encode('ascii')
+        return b''.join(lines)
+
+def CombineInits(inits, nevents):
+    # Combine the <init> blocks of statistically independent runs of the same
+    # process: XSECUP is the event-weighted mean, XERRUP is combined the same
+    # way in quadrature and XMAXUP is the largest one. Inputs that still have
+    # the unset (<= 0) cross-section leave the first block's values alone.
+    # Raises ValueError if the blocks do not describe the same process.
+    combined = inits[0]
+    for init in inits[1:]:
+        if not combined.isCompatible(init):
+            raise ValueError("Incompatible <init> blocks: {0} vs {1}".format(
+                             b' '.join(combined.beams), b' '.join(init.beams)))
+    total = float(sum(nevents))
+    if total == 0: return combined
+    for i, process in enumerate(combined.processes):
+        xsecs = [init.processes[i][0] for init in inits]
+        if min(xsecs) <= 0: continue
+        process[0] = sum(n*init.processes[i][0] for n, init in zip(nevents, inits))/total
+        process[1] = sum((n*init.processes[i][1])**2 for n, init in zip(nevents, inits))**0.5/total
+        process[2] = max(init.processes[i][2] for init in inits)
+    return combined
+
+#--------------Transforms--------------------------------------------------
+def ReplaceField(line, index, value):
+    # Replace the index-th whitespace separated field of a line, keeping the
+    # spacing around it
+    match = list(re.finditer(br'\S+', line))[index]
+    return line[:match.start()]+value+line[match.end():]
+
+class ScaleScalup( object ):
+
+    ##
+    # @short Event transform: multiply SCALUP by a constant factor
+    def __init__( self, factor ):
+        self.factor = factor
+
+    def event( self, event ):
+        scalup = ('%.5E' % (event.scale*self.factor)).encode('ascii')
+        event.setLine(1, ReplaceField(event.lines[1], 3, scalup))
+
+class SetCrossSection( object ):
+
+    ##
+    # @short Init transform: set XSECUP/XERRUP of every process
+    #
+    # With only_unset the values are only filled in where the generator left
+    # the -1 placeholder.
+    def __init__( self, xsec, xerr, only_unset = False ):
+        self.xsec = xsec
+        self.xerr = xerr
+        self.only_unset = only_unset
+
+    def init( self, init ):
+        for process in init.processes:
+            if self.only_unset and process[0] != -1.0: continue
+            process[0] = self.xsec
+            process[1] = self.xerr
+
+class RemapPID( object ):
+
+    ##
+    # @short Event transform: change particle IDs, e.g. {13: 15, -13: -15}
+    #
+    # Only the IDUP column of the particle lines is looked at.
+    def __init__( self, mapping ):
+        self.mapping = dict((str(k).encode('ascii'), str(v).encode('ascii')) for k, v in mapping.items())
+
+    def event( self, event ):
+        mapping = self.mapping
+        for i in range(2, 2+event.nparticles):
+            line = event.lines[i]
+            pid = line.split(None, 1)[0]
+            if pid in mapping: event.setLine(i, ReplaceField(line, 0, mapping[pid]))
+
+MUON_TO_TAU = {13: 15, -13: -15, 14: 16, -14: -16}
+
+def TransformLHE(task):
+    # Apply a list of transforms to one file in a single streaming pass and
+    # replace the file with the result (kept in the same compression). Init
+    # transforms have an init() method, event transforms an event() method.
+    # task is (filename, transforms) so that it can go through a Pool.
+    filename, transforms = task
+    if filename.endswith(('.tar.gz', '.tgz')):
+        raise ValueError("Cannot rewrite {0} in place, extract it first".format(filename))
+    init_transforms = [t for t in transforms if hasattr(t, 'init')]
+    event_transforms = [t for t in transforms if hasattr(t, 'event')]
+    compress = filename.endswith('.gz')
+    tmp_name = filename[:-3]+'.1.gz' if compress else filename+'.1'
+    with LHEReader(filename) as reader:
+        with OpenLHEOutput(tmp_name, compress) as outfile:
+            init = LHEInit(reader.init)
+            for transform in init_transforms:
+                transform.init(init)
+            outfile.write(reader.header)
+            outfile.write(init.text() if init_transforms else reader.init)
+            for event in reader.events():
+                for transform in event_transforms:
+                    transform.event(event)
+                event.write(outfile)
+            outfile.write(reader.footer)
+        nevents = reader.nevents
+    os.rename(tmp_name, filename)
+    return filename, nevents
+
+#--------------Reader-------------------------------------------------------
+class LHEReader( object ):
+
+    ##
+    # @short Streaming reader for LHE files
+    #
+    # On construction the file is read up to the end of the <init> block, which
+    # fills header (everything before the <init> line) and init (the <init>
+    # block itself). events() then yields LHEEvent objects. Once it has been
+    # exhausted, footer holds whatever came after the last complete event and
+    # truncated is True if the file ends inside an event.
+    #
+    # With start/stop only the byte range [start, stop) of an uncompressed
+    # file is read, which has to begin on an event line (see EventByteRanges).
+    # The header is not parsed then, header and init stay empty.
+    def __init__( self, filename, chunk_size = CHUNK_SIZE, start = None, stop = None ):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.header = b''
+        self.init = b''
+        self.footer = b''
+        self.truncated = False
+        self.nevents = 0
+        self._buf = b''
+        self._base = 0		# file offset of self._buf[0]
+        self._eof = False
+        self._left = -1		# bytes left to read in a range, -1 for the whole file
+        if start is None:
+            self._file = OpenLHE(filename, chunk_size)
+            self._readHeader()
+        else:
+            self._file = open(filename, 'rb')
+            self._file.seek(start)
+            self._base = start
+            if stop is not None: self._left = max(stop-start, 0)
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def close( self ):
+        self._file.close()
+
+    def _fill( self, pos ):
+        # Drop the consumed part of the buffer and append the next chunk.
+        # Returns False once the end of the file has been reached.
+        self._base += pos
+        if self._left >= 0:
+            data = self._file.read(min(self.chunk_size, self._left))
+            self._left -= len(data)
+        else:
+            data = self._file.read(self.chunk_size)
+        if not data:
+            self._buf = self._buf[pos:]
+            self._eof = True
+            return False
+        self._buf = self._buf[pos:] + data
+        return True
+
+    def _readHeader( self ):
+        while True:
+            end_init = self._buf.find(b'</init>')
+            first_event = self._buf.find(b'<event>')
+            if end_init >= 0 or first_event >= 0 or self._eof:
+                break
+            self._fill(0)
+        if end_init >= 0 and (first_event < 0 or end_init < first_event):
+            eol = self._buf.find(b'\n', end_init)
+            while eol < 0 and not self._eof:
+                self._fill(0)
+                eol = self._buf.find(b'\n', end_init)
+            if eol < 0: eol = len(self._buf)-1
+            start_init = self._buf.rfind(b'\n', 0, self._buf.find(b'<init>'))+1
+            self.header = self._buf[:start_init]
+            self.init = self._buf[start_init:eol+1]
+            self._fill(eol+1)
+        elif first_event >= 0:
+            start = self._buf.rfind(b'\n', 0, first_event)+1
+            self.header = self._buf[:start]
+            self._fill(start)
+
+    def skipTo( self, offset ):
+        # Carry on reading at byte offset of the (decompressed) text, which has
+        # to lie between two events. The text before it is read and dropped.
+        while self._base+len(self._buf) < offset:
+            if not self._fill(len(self._buf)): break
+        self._buf = self._buf[offset-self._base:]
+        self._base = offset
+
+    def events( self ):
+        pos = 0
+        while True:
+            buf = self._buf
+            start = buf.find(b'<event>', pos)
+            end = buf.find(b'</event>', start) if start >= 0 else -1
+            eol = buf.find(b'\n', end) if end >= 0 else -1
+            if eol < 0:
+                if self._fill(pos):
+                    pos = 0
+                    continue
+                # End of file: the last event may lack its newline, anything
+                # else left over is the footer or a cut-off event.
+                buf = self._buf
+                pos = 0
+                start = buf.find(b'<event>')
+                end = buf.find(b'</event>', start) if start >= 0 else -1
+                if end < 0:
+                    self.truncated = start >= 0
+                    self.footer = buf
+                    return
+                eol = len(buf)-1
+            line_start = max(buf.rfind(b'\n', pos, start)+1, pos)
+            self.nevents += 1
+            yield LHEEvent(buf[line_start:eol+1], self._base+line_start)
+            pos = eol+1
+
+def OpenLHEAt(filename, offset, stop = None, chunk_size = CHUNK_SIZE):
+    # LHEReader that starts at byte offset of the (decompressed) text, e.g.
+    # the end of the last event a checkpoint covered. Plain files are seeked
+    # into, compressed ones are read from the start and skipped up to offset.
+    if not IsCompressed(filename): return LHEReader(filename, chunk_size, offset, stop)
+    reader = LHEReader(filename, chunk_size)
+    reader.skipTo(offset)
+    return reader
+
+def ReadLHE(filename, chunk_size = CHUNK_SIZE):
+    # Convenience generator over the events of a single file
+    with LHEReader(filename, chunk_size) as reader:
+        for event in reader.events():
+            yield event
+
+#--------------Event index--------------------------------------------------
+INDEX_SUFFIX = '.idx'
+
+class LHEIndex( object ):
+
+    ##
+    # @short Byte offsets of every event in an LHE file
+    #
+    # starts/ends are numpy int64 arrays with the same [start, end) spans as
+    # LHEEvent.text/offset. init_start/init_end delimit the <init> block, so
+    # [0, init_end) is everything that has to be copied in front of a set of
+    # events. size and mtime identify the version of the file that was indexed.
+    # An index read without its events (ReadLHEIndex with events=False) has
+    # starts/ends set to None and only knows nevents.
+    def __init__( self, filename, starts, ends, init_start, init_end, size, mtime, truncated, nevents = None ):
+        self.filename = filename
+        self.starts = starts
+        self.ends = ends
+        self.nevents = len(starts) if starts is not None else int(nevents)
+        self.init_start = int(init_start)
+        self.init_end = int(init_end)
+        self.size = int(size)
+        self.mtime = float(mtime)
+        self.truncated = bool(truncated)
+
+    @property
+    def footer_start( self ):
+        # First byte after the last complete event
+        if len(self.ends): return int(self.ends[-1])
+        return self.init_end
+
+    def isCurrent( self ):
+        stat = os.stat(self.filename)
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+    def save( self, index_name = None ):
+        if index_name is None: index_name = self.filename+INDEX_SUFFIX
+        tmp_name = index_name+'.tmp'
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, starts=self.starts, ends=self.ends,
+                     spans=np.array([self.init_start, self.init_end, self.size, self.nevents], dtype=np.int64),
+                     mtime=np.array([self.mtime], dtype=np.float64),
+                     truncated=np.array([self.truncated], dtype=np.bool_))
+        os.rename(tmp_name, index_name)
+
+def _ScanEvents(mm, pos, stop):
+    # Event spans in [pos, stop) of an mmap, where pos and stop lie on event
+    # boundaries. Returns (starts, ends, truncated).
+    starts = array.array('l')
+    ends = array.array('l')
+    truncated = False
+    find = mm.find
+    while True:
+        start = find(b'<event>', pos, stop)
+        if start < 0: break
+        end = find(b'</event>', start, stop)
+        if end < 0:
+            truncated = True
+            break
+        eol = find(b'\n', end, stop)
+        eol = eol+1 if eol >= 0 else stop
+        starts.append(max(mm.rfind(b'\n', pos, start)+1, pos))
+        ends.append(eol)
+        pos = eol
+    return starts, ends, truncated
+
+def _IndexRange(task):
+    filename, start, stop = task
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts, ends, truncated = _ScanEvents(mm, start, stop)
+        finally:
+            mm.close()
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), truncated
+
+def BuildLHEIndex(filename, jobs = 1):
+    # Scan the file through mmap, looking only for the event tags. With
+    # jobs > 1 the event region is cut into byte ranges (see EventByteRanges)
+    # that are scanned by parallel workers and joined in order.
+    stat = os.stat(filename)
+    init_start = init_end = 0
+    parts = []
+    with open(filename, 'rb') as f:
+        if stat.st_size > 0:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                size = mm.size()
+                first_event = mm.find(b'<event>')
+                end_init = mm.find(b'</init>', 0, first_event if first_event >= 0 else size)
+                if end_init >= 0:
+                    eol = mm.find(b'\n', end_init)
+                    init_end = eol+1 if eol >= 0 else size
+                    tag = mm.rfind(b'<init>', 0, end_init)
+                    init_start = mm.rfind(b'\n', 0, tag)+1 if tag >= 0 else 0
+                else:
+                    init_end = mm.rfind(b'\n', 0, first_event)+1 if first_event >= 0 else size
+                    init_start = init_end
+                if jobs <= 1:
+                    starts, ends, truncated = _ScanEvents(mm, init_end, size)
+                    parts.append((np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), truncated))
+            finally:
+                mm.close()
+    if stat.st_size > 0 and jobs > 1:
+        tasks = [(filename, start, stop) for start, stop in EventByteRanges(filename, jobs*4, init_end)]
+        parts = [part for task, part in RunParallel(_IndexRange, tasks, jobs, progress=False, ordered=True)]
+    if not parts: parts = [(np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), False)]
+    return LHEIndex(filename, np.concatenate([part[0] for part in parts]),
+                    np.concatenate([part[1] for part in parts]),
+                    init_start, init_end, stat.st_size, stat.st_mtime, parts[-1][2])
+
+def ReadLHEIndex(filename, events = True):
+    # The index from the sidecar file if it still matches the size and mtime
+    # of the LHE file, otherwise None. With events=False the event offsets
+    # are not loaded, only the small spans record with the number of events.
+    index_name = filename+INDEX_SUFFIX
+    if not os.path.isfile(index_name): return None
+    try:
+        with open(index_name, 'rb') as f:
+            data = np.load(f)
+            spans = data['spans']
+            if events:
+                starts, ends, nevents = data['starts'], data['ends'], None
+            else:
+                # Sidecars written before the count was kept in spans
+                starts, ends = None, None
+                nevents = spans[3] if len(spans) > 3 else len(data['starts'])
+            index = LHEIndex(filename, starts, ends, spans[0], spans[1], spans[2],
+                             data['mtime'][0], data['truncated'][0], nevents)
+        if index.isCurrent(): return index
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    return None
+
+def LoadLHEIndex(filename, save = True, jobs = 1):
+    # Return the index of filename, using the sidecar file when it is still
+    # current and rebuilding (and saving) it otherwise.
+    index = ReadLHEIndex(filename)
+    if index is not None: return index
+    index = BuildLHEIndex(filename, jobs)
+    if save:
+        try:
+            index.save()
+        except (IOError, OSError):
+            pass	# e.g. read-only input directory, the index is still usable
+    return index
+
+def CountEvents(filename, jobs = 1):
+    # Plain files are answered from the count in the index, compressed ones
+    # are streamed
+    if IsCompressed(filename):
+        with LHEReader(filename) as reader:
+            for event in reader.events(): pass
+            return reader.nevents
+    index = ReadLHEIndex(filename, events=False)
+    if index is not None: return index.nevents
+    return LoadLHEIndex(filename, jobs=jobs).nevents
+
+RANGE_SIZE = 1 << 28	# 256 MB of events per worker task by default
+
+def EventByteRanges(filename, nchunks = None, first = None):
+    # Cut the events of one uncompressed file into nchunks consecutive byte
+    # ranges [start, stop) that each begin on an event line, so the ranges can
+    # be parsed independently (LHEReader with start/stop) by parallel workers
+    # and their results merged. A current index is used when there is one,
+    # otherwise the file is probed at evenly spaced offsets for the next
+    # <event> tag. The default is one range per RANGE_SIZE bytes. first is the
+    # offset where the events start (after the <init> block); it is looked up
+    # when not given. Compressed files are returned as a single range.
+    size = os.path.getsize(filename)
+    if IsCompressed(filename): return [(None, None)]
+    if nchunks is None: nchunks = max(1, -(-size//RANGE_SIZE))
+    index = ReadLHEIndex(filename)
+    if index is not None:
+        if index.nevents < nchunks: nchunks = max(index.nevents, 1)
+        cuts = [int(index.init_end)] + [int(index.starts[(index.nevents*k)//nchunks]) for k in range(1, nchunks)]
+    else:
+        with open(filename, 'rb') as f:
+            if size == 0: return [(0, 0)]
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if first is None:
+                    first_event = mm.find(b'<event>')
+                    first = mm.rfind(b'\n', 0, first_event)+1 if first_event >= 0 else size
+                cuts = [first]
+                for k in range(1, nchunks):
+                    probe = mm.find(b'\n', first + ((size-first)*k)//nchunks)
+                    tag = mm.find(b'<event>', probe) if probe >= 0 else -1
+                    cuts.append(mm.rfind(b'\n', 0, tag)+1 if tag >= 0 else size)
+            finally:
+                mm.close()
+    cuts.append(size)
+    ranges = [(start, stop) for start, stop in zip(cuts[:-1], cuts[1:]) if stop > start]
+    return ranges if ranges else [(cuts[0], size)]
+
+def CopyRange(infile, outfile, start, stop, block_size = CHUNK_SIZE):
+    # Copy bytes [start, stop) of an open input file to an open output file
+    infile.seek(int(start))
+    remaining = int(stop)-int(start)
+    while remaining > 0:
+        data = infile.read(min(block_size, remaining))
+        if not data: break
+        outfile.write(data)
+        remaining -= len(data)
+
+def _LibcSendfile():
+    # sendfile(2) through ctypes, for Python 2 which has no os.sendfile.
+    # Only on Linux, where it copies between regular files (kernel >= 2.6.33).
+    if not sys.platform.startswith('linux'): return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError, ImportError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    function.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        position = ctypes.c_int64(offset)
+        sent = function(out_fd, in_fd, ctypes.byref(position), min(count, 1 << 30))
+        if sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return sent
+    return sendfile
+
+_sendfile = getattr(os, 'sendfile', None) or _LibcSendfile()
+
+def SendRange(infile, outfile, start, stop):
+    # Same as CopyRange, but the kernel moves the data (copy_file_range or
+    # sendfile, the latter through ctypes on Python 2) when the platform has
+    # it. Only for plain, uncompressed files.
+    start = int(start)
+    stop = int(stop)
+    outfile.flush()
+    in_fd = infile.fileno()
+    out_fd = outfile.fileno()
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while start < stop:
+                sent = os.copy_file_range(in_fd, out_fd, stop-start, start)
+                if sent == 0: break
+                start += sent
+        elif _sendfile is not None:
+            while start < stop:
+                sent = _sendfile(out_fd, in_fd, start, stop-start)
+                if sent == 0: break
+                start += sent
+    except OSError:
+        pass	# e.g. cross-device copy or no kernel support, finish below
+    if start < stop:
+        CopyRange(infile, outfile, start, stop)
+    # Python 2 file objects keep their own idea of the position
+    outfile.seek(0, os.SEEK_END)
+
+#--------------Truncated files---------------------------------------------
+def CountTag(infile, start, stop, tag = b'<event>', block_size = CHUNK_SIZE):
+    # Count occurrences of tag in bytes [start, stop) of an open file
+    infile.seek(start)
+    count = 0
+    carry = b''
+    remaining = stop-start
+    while remaining > 0:
+        data = infile.read(min(block_size, remaining))
+        if not data: break
+        remaining -= len(data)
+        buf = carry+data
+        count += buf.count(tag)
+        carry = buf[-(len(tag)-1):]	# too short to hold a whole tag, never counted twice
+    return count
+
+def FindLastEventEnd(infile, size, block_size = 1 << 16):
+    # Seek backwards from the end in fixed-size blocks for the last </event>.
+    # Returns the offset just past the end of that line, or -1 if there is none.
+    pos = size
+    carry = b''
+    while pos > 0:
+        start = max(0, pos-block_size)
+        infile.seek(start)
+        buf = infile.read(pos-start)+carry
+        found = buf.rfind(b'</event>')
+        if found >= 0:
+            found += start
+            infile.seek(found)
+            line = infile.readline()
+            return found+len(line)
+        carry = buf[:len(b'</event>')-1]
+        pos = start
+    return -1
+
+def RepairLHE(filename, block_size = 1 << 16):
+    # Cut a file back to its last complete event in place and close it with
+    # </LesHouchesEvents>. Only the tail of the file is read, whatever its size.
+    # Returns (filename, events dropped, bytes removed, changed); bytes removed
+    # is -1 when the file has no complete event at all and was left untouched,
+    # changed is False when the file was already complete.
+    with open(filename, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        end = FindLastEventEnd(f, size, block_size)
+        if end < 0: return filename, 0, -1, False
+        f.seek(end)
+        if f.read(64).strip() == b'</LesHouchesEvents>': return filename, 0, 0, False
+        dropped = CountTag(f, end, size)
+        f.seek(end-1)
+        newline = f.read(1) == b'\n'
+        f.truncate(end)
+        f.seek(end)
+        # The last </event> may be the very end of the file, without a newline
+        if not newline: f.write(b'\n')
+        f.write(b'</LesHouchesEvents>\n')
+    return filename, dropped, size-end, True
+
+#--------------Cross-section------------------------------------------------
+class XSAccumulator( object ):
+
+    ##
+    # @short Running sums of the event weights for a set of weight shifts
+    #
+    # nevents, sumw and sumw2 (one entry per shift) are all that is needed to
+    # get the cross-section and its error, so accumulators from different
+    # files or processes can simply be added together. Per-file accumulators
+    # can be kept next to the file (SaveXSRecord/LoadXSRecord).
+    #
+    # The sums are kept exactly (see ExactColumnSums) and only rounded when
+    # sumw/sumw2 are read. Adding accumulators is then truly associative:
+    # the result does not depend on how the events were split over ranges,
+    # processes or stored records, nor on the order they are added in.
+    def __init__( self, num_shifts ):
+        self.nevents = 0
+        self.exact_sumw = [0]*num_shifts
+        self.exact_sumw2 = [0]*num_shifts
+
+    @property
+    def sumw( self ):
+        return np.array([ExactToFloat(value) for value in self.exact_sumw], dtype=np.float64)
+
+    @property
+    def sumw2( self ):
+        return np.array([ExactToFloat(value) for value in self.exact_sumw2], dtype=np.float64)
+
+    def fill( self, weights ):
+        # weights is an (events x shifts) array
+        self.nevents += weights.shape[0]
+        for first in range(0, weights.shape[0], 1 << 26):
+            block = weights[first:first+(1 << 26)]
+            self.exact_sumw = [a+b for a, b in zip(self.exact_sumw, ExactColumnSums(block))]
+            self.exact_sumw2 = [a+b for a, b in zip(self.exact_sumw2, ExactColumnSums(block*block))]
+
+    def add( self, other ):
+        self.nevents += other.nevents
+        self.exact_sumw = [a+b for a, b in zip(self.exact_sumw, other.exact_sumw)]
+        self.exact_sumw2 = [a+b for a, b in zip(self.exact_sumw2, other.exact_sumw2)]
+        return self
+
+    def result( self ):
+        # Returns (xsec, xsec error) arrays, same estimator as the old
+        # event-by-event loop in calc_XS.py.
+        n = np.float64(self.nevents)
+        if n == 0: return np.zeros_like(self.sumw), np.zeros_like(self.sumw)
+        xsecval = self.sumw/n
+        xsecerr2 = (self.sumw2/n - xsecval*xsecval)/n
+        xsecerr2[xsecerr2 < 0] = 0.0
+        return xsecval, np.sqrt(xsecerr2)
+
+XS_SUFFIX = '.xs.npz'
+
+def SaveXSRecord(filename, acc, stat = None):
+    # Store acc next to filename as <file>.xs.npz together with the size and
+    # mtime (stat, taken before the file was read) it was computed for. The
+    # exact sums are stored as hex strings.
+    if stat is None: stat = os.stat(filename)
+    record_name = filename+XS_SUFFIX
+    tmp_name = record_name+'.tmp'
+    with open(tmp_name, 'wb') as f:
+        np.savez(f, nevents=np.array([acc.nevents], dtype=np.int64),
+                 sumw=np.array(['%x' % value for value in acc.exact_sumw]),
+                 sumw2=np.array(['%x' % value for value in acc.exact_sumw2]),
+                 size=np.array([stat.st_size], dtype=np.int64), mtime=np.array([stat.st_mtime], dtype=np.float64))
+    os.rename(tmp_name, record_name)
+
+def LoadXSRecord(filename, num_shifts):
+    # The stored XSAccumulator of filename for the first num_shifts shifts, or
+    # None if there is no record, it has fewer shifts or the file changed
+    record_name = filename+XS_SUFFIX
+    if not os.path.isfile(record_name): return None
+    try:
+        stat = os.stat(filename)
+        with open(record_name, 'rb') as f:
+            data = np.load(f)
+            if data['size'][0] != stat.st_size or data['mtime'][0] != stat.st_mtime: return None
+            if len(data['sumw']) < num_shifts: return None
+            acc = XSAccumulator(num_shifts)
+            acc.nevents = int(data['nevents'][0])
+            acc.exact_sumw = [int(value, 16) for value in data['sumw'][:num_shifts]]
+            acc.exact_sumw2 = [int(value, 16) for value in data['sumw2'][:num_shifts]]
+        return acc
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def EventWeights(event, num_shifts):
+    # Raw XWGTUP token followed by the first num_shifts-1 "#new" weight tokens.
+    # Only these lines are looked at, particle lines are never split.
+    text = event.text
+    info_start = text.find(b'\n')+1
+    tokens = [text[info_start:text.find(b'\n', info_start)].split()[2]]
+    pos = info_start
+    for i in range(num_shifts-1):
+        pos = text.find(b'#new', pos)
+        if pos < 0:
+            raise ValueError("Event at byte {0} has fewer than {1} #new weights".format(event.offset, num_shifts-1))
+        eol = text.find(b'\n', pos)
+        tokens.append(text[pos:eol].split()[2])
+        pos = eol
+    return tokens
+
+def AccumulateWeights(filename, num_shifts, batch_size = 100000, start = None, stop = None,
+                      checkpoint = None, interval = None):
+    # Weights-only pass over one file, or over the byte range [start, stop) of
+    # it. Weights are converted to a numpy array and summed one batch of
+    # events at a time. The weights of a warm cache entry (see BuildLHECache)
+    # are summed directly when the whole file is asked for.
+    #
+    # With checkpoint (a CheckpointName) the partial sums are saved every
+    # interval bytes of input and once more when the pass is complete. A pass
+    # over the same file and range picks up from there instead of from the
+    # start, the caller removes the checkpoint once the result is stored.
+    acc = XSAccumulator(num_shifts)
+    cached = OpenLHECache(filename) if start is None and stop is None else None
+    if cached is not None and cached.weights.shape[1] >= num_shifts:
+        weights = cached.weights
+        for first in range(0, weights.shape[0], batch_size):
+            acc.fill(np.array(weights[first:first+batch_size, :num_shifts]))
+        return acc
+    if interval is None: interval = CHECKPOINT_BYTES
+    state = LoadCheckpoint(checkpoint, filename) if checkpoint else None
+    if state is not None and [state['start'], state['stop'], state['num_shifts']] == [start, stop, num_shifts]:
+        acc.nevents = state['nevents']
+        acc.exact_sumw = [int(value, 16) for value in state['sumw']]
+        acc.exact_sumw2 = [int(value, 16) for value in state['sumw2']]
+        if state['done']: return acc
+        reader = OpenLHEAt(filename, state['offset'], stop)
+    else:
+        reader = LHEReader(filename, start=start, stop=stop)
+
+    def save(offset, done):
+        try:
+            SaveCheckpoint(checkpoint, filename, {'start': start, 'stop': stop, 'num_shifts': num_shifts,
+                                                  'offset': offset, 'done': done, 'nevents': acc.nevents,
+                                                  'sumw': ['%x' % value for value in acc.exact_sumw],
+                                                  'sumw2': ['%x' % value for value in acc.exact_sumw2]})
+        except (IOError, OSError):
+            pass	# e.g. read-only input directory, the pass just cannot be resumed
+
+    tokens = []
+    last = None
+    with reader:
+        for event in reader.events():
+            tokens.extend(EventWeights(event, num_shifts))
+            end = event.offset+len(event.text)
+            if last is None: last = event.offset
+            if len(tokens) >= batch_size*num_shifts or (checkpoint and end-last >= interval):
+                acc.fill(np.array(tokens).astype(np.float64).reshape(-1, num_shifts))
+                tokens = []
+                if checkpoint and end-last >= interval:
+                    save(end, False)
+                    last = end
+    if tokens:
+        acc.fill(np.array(tokens).astype(np.float64).reshape(-1, num_shifts))
+    if checkpoint: save(None, True)
+    return acc
+
+#--------------Weight matrix------------------------------------------------
+WEIGHTS_SUFFIX = '.weights.npy'
+
+def WeightMatrixName(filename):
+    # <dir>/<base>.weights.npy next to the LHE file
+    return os.path.join(os.path.dirname(filename), LHEBaseName(filename)+WEIGHTS_SUFFIX)
+
+class NpyWriter( object ):
+
+    ##
+    # @short Streaming writer of a .npy array whose length is not known yet
+    #
+    # Rows of dtype (with columns entries each, or scalars if columns is None)
+    # are appended to a temporary file by fill(). close() writes the .npy
+    # header in front of them and renames the result into place, so a reader
+    # never sees a half-written file. With record set, every row is stored as
+    # one record of that structured dtype instead.
+    #
+    # sync() returns the size of the row data safely on disk, in bytes like
+    # CheckpointOutput.sync(). Given that size, an unfinished writer is
+    # reopened and carries on after the last row it holds.
+    def __init__( self, filename, dtype, columns = None, record = None, size = None ):
+        self.filename = filename
+        self.nrows = 0
+        self._dtype = np.dtype(dtype).newbyteorder('<')
+        self._columns = columns
+        self._record = record
+        self._tmp_name = filename+'.tmp'
+        if size is None:
+            self._data = open(self._tmp_name, 'wb')
+        else:
+            self.nrows = size//(self._dtype.itemsize*(columns or 1))
+            self._data = open(self._tmp_name, 'r+b')
+            self._data.truncate(self.nrows*self._dtype.itemsize*(columns or 1))
+            self._data.seek(0, 2)
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def fill( self, rows ):
+        rows = np.ascontiguousarray(rows, dtype=self._dtype)
+        self.nrows += rows.shape[0]
+        self._data.write(rows.tobytes())
+
+    def sync( self ):
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        return self._data.tell()
+
+    def close( self ):
+        if self._data is None: return
+        self._data.close()
+        self._data = None
+        if self._record is not None:
+            descr, shape = np.lib.format.dtype_to_descr(self._record), (self.nrows,)
+        elif self._columns is None:
+            descr, shape = np.lib.format.dtype_to_descr(self._dtype), (self.nrows,)
+        else:
+            descr, shape = np.lib.format.dtype_to_descr(self._dtype), (self.nrows, self._columns)
+        header = {'descr': descr, 'fortran_order': False, 'shape': shape}
+        with open(self._tmp_name, 'rb') as data, open(self.filename+'.part', 'wb') as out:
+            np.lib.format.write_array_header_1_0(out, header)
+            CopyRange(data, out, 0, os.path.getsize(self._tmp_name))
+        os.remove(self._tmp_name)
+        os.rename(self.filename+'.part', self.filename)
+
+class WeightMatrixWriter( NpyWriter ):
+
+    ##
+    # @short Streaming writer of an (events x variations) weight matrix
+    #
+    # The matrix is stored as a .npy file of float64 records with one named
+    # field per variation, so np.load(name, mmap_mode='r') maps it without
+    # reading it, matrix['MuFup'] is the column of one variation and
+    # matrix.view(np.float64).reshape(-1, len(names)) the plain 2-D array.
+    # fill() takes (events x variations) arrays.
+    def __init__( self, filename, names, size = None ):
+        self.names = list(names)
+        NpyWriter.__init__(self, filename, np.float64, len(self.names),
+                           np.dtype([(str(name), '<f8') for name in self.names]), size)
+
+    @property
+    def nevents( self ):
+        return self.nrows
+
+def LoadWeightMatrix(filename):
+    # Memory-mapped weight matrix of an LHE file (see WeightMatrixWriter)
+    return np.load(WeightMatrixName(filename), mmap_mode='r')
+
+def WeightColumn(filename, name):
+    # The weights of one variation, one entry per event
+    return LoadWeightMatrix(filename)[name]
+
+#--------------HepMC output------------------------------------------------
+HEPMC_HEADER = b'\nHepMC::Version 2.06.09\nHepMC::IO_GenEvent-START_EVENT_LISTING\n'
+HEPMC_FOOTER = b'HepMC::IO_GenEvent-END_EVENT_LISTING\n\n'
+
+def SelectWeight(event, index):
+    # Event weight of one variation: 0 is XWGTUP, k the k-th "#new" weight
+    if index == 0: return event.weight
+    return float(EventWeights(event, index+1)[index])
+
+class HepMCWriter( object ):
+
+    ##
+    # @short Streaming HepMC2 (IO_GenEvent) ASCII writer for LHE events
+    #
+    # Every LHE event becomes one GenEvent: the two beams (from the <init>
+    # block) go into a beam vertex whose outgoing particles are the incoming
+    # partons, those meet at the hard vertex, and every intermediate
+    # resonance (ISTUP 2) gets its own decay vertex. Colour flow is kept.
+    # Incoming partons get status 3, resonances 2 and final-state particles 1,
+    # as lhef2hepmc does. Each event carries a single weight called
+    # weight_name. Only the output file object is needed, so it can just as
+    # well be a named pipe read by Rivet.
+    def __init__( self, outfile, init = None, weight_name = 'Nominal' ):
+        self._out = outfile
+        self.weight_name = weight_name
+        self.nevents = 0
+        self._beams = None
+        self._xsec = None
+        if init is not None:
+            self._beams = (int(init.beams[0]), int(init.beams[1]), float(init.beams[2]), float(init.beams[3]))
+            xsec = sum(process[0] for process in init.processes)
+            if xsec > 0:
+                self._xsec = (xsec, sum(process[1]**2 for process in init.processes)**0.5)
+        outfile.write(HEPMC_HEADER)
+
+    def close( self ):
+        self._out.write(HEPMC_FOOTER)
+        self._out.flush()
+
+    def write( self, event, weight = None ):
+        if weight is None: weight = event.weight
+        info = event.info
+        particles = event.particles
+        n = len(particles)
+        status = [int(p[1]) for p in particles]
+        # Production vertex of every particle: 'beam', 'hard' or the index of
+        # the decaying resonance. The end vertex follows from the productions.
+        production = []
+        for i, p in enumerate(particles):
+            mother = int(p[2])-1
+            if status[i] == -1: production.append('beam')
+            elif 0 <= mother < n and status[mother] != -1: production.append(mother)
+            else: production.append('hard')
+        vertices = ['hard']
+        if self._beams is not None: vertices.insert(0, 'beam')
+        for vertex in production:
+            if vertex not in vertices and vertex != 'beam': vertices.append(vertex)
+        barcode = dict((vertex, -1-k) for k, vertex in enumerate(vertices))
+        end = [barcode['hard'] if status[i] == -1 else barcode.get(i, 0) for i in range(n)]
+
+        self.nevents += 1
+        beam_barcodes = (1, 2) if self._beams is not None else (0, 0)
+        lines = ['E %d -1 %.16e %.16e %.16e %d %d %d %d %d 0 1 %.16e\n' % (
+                 self.nevents, float(info[3]), float(info[5]), float(info[4]), int(info[1]),
+                 barcode['hard'], len(vertices), beam_barcodes[0], beam_barcodes[1], weight),
+                 'N 1 "%s"\n' % self.weight_name, 'U GEV MM\n']
+        if self._xsec is not None: lines.append('C %.16e %.16e\n' % self._xsec)
+        for vertex in vertices:
+            if vertex == 'beam':
+                orphans = [self._beamLine(k, barcode['beam']) for k in (0, 1)]
+            elif vertex == 'hard' and self._beams is None:
+                orphans = [self._particleLine(particles[i], i, 3, end[i]) for i in range(n) if status[i] == -1]
+            else:
+                orphans = []
+            outgoing = [self._particleLine(particles[i], i, self._status(status[i]), end[i])
+                        for i in range(n) if production[i] == vertex]
+            lines.append('V %d 0 0 0 0 0 %d %d 0\n' % (barcode[vertex], len(orphans), len(outgoing)))
+            lines.extend(orphans)
+            lines.extend(outgoing)
+        self._out.write(''.join(lines).encode('ascii'))
+
+    def _status( self, status ):
+        if status == 1: return 1
+        if status == 2: return 2
+        return 3
+
+    def _beamLine( self, k, end_vertex ):
+        pid, energy = self._beams[k], self._beams[k+2]
+        pz = energy if k == 0 else -energy
+        return 'P %d %d 0 0 %.16e %.16e 0 4 0 0 %d 0\n' % (k+1, pid, pz, energy, end_vertex)
+
+    def _particleLine( self, p, i, status, end_vertex ):
+        flows = [(k, int(c)) for k, c in ((1, p[4]), (2, p[5])) if int(c) != 0]
+        return 'P %d %d %.16e %.16e %.16e %.16e %.16e %d 0 0 %d %d%s\n' % (
+               i+3, int(p[0]), float(p[6]), float(p[7]), float(p[8]), float(p[9]), float(p[10]),
+               status, end_vertex, len(flows), ''.join(' %d %d' % flow for flow in flows))
+
+#--------------Columnar batches---------------------------------------------
+NUM_PARTICLE_COLUMNS = 13	# IDUP ISTUP MOTHUP(2) ICOLUP(2) PUP(5) VTIMUP SPINUP
+
+class LHEBatch( object ):
+
+    ##
+    # @short Columnar (numpy) view of a block of events
+    #
+    # weight has one entry per event. The particle columns (pid, status, px,
+    # py, pz, e, m) hold all particles of the block back to back, and the
+    # particles of event i are offsets[i]:offsets[i+1]. weights is only set
+    # when the variations were asked for, it is (events x variations) with
+    # XWGTUP first and the "#new" weights after it.
+    def __init__( self, weight, offsets, pid, status, px, py, pz, e, m, weights = None ):
+        self.weight = weight
+        self.weights = weights
+        self.offsets = offsets
+        self.pid = pid
+        self.status = status
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.e = e
+        self.m = m
+
+    @property
+    def nevents( self ):
+        return len(self.weight)
+
+    @property
+    def nparticles( self ):
+        # Number of particles in each event
+        return np.diff(self.offsets)
+
+def EventBatch(events, num_weights = None):
+    # Build an LHEBatch from a list of LHEEvent. All particle lines of the
+    # block are split in one go and converted column by column. With
+    # num_weights the first num_weights weights (see EventWeights) of every
+    # event are filled in as well.
+    weights = []
+    counts = []
+    chunks = []
+    for event in events:
+        info = event.info
+        counts.append(int(info[0]))
+        weights.append(info[2])
+        chunks.extend(event.particle_lines)
+    offsets = np.zeros((len(counts)+1,), dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    tokens = b''.join(chunks).split()
+    if len(tokens) == offsets[-1]*NUM_PARTICLE_COLUMNS:
+        table = np.array(tokens).reshape(-1, NUM_PARTICLE_COLUMNS)
+    else:
+        # Some writers drop or add trailing columns, only the first 11 are needed
+        table = np.array([line.split()[:11] for line in chunks])
+        if table.ndim != 2 or table.shape[1] != 11:
+            raise ValueError("Malformed particle line in block starting at byte {0}".format(events[0].offset))
+    variations = None
+    if num_weights:
+        variations = np.array([token for event in events for token in EventWeights(event, num_weights)])
+        variations = variations.astype(np.float64).reshape(-1, num_weights)
+    return LHEBatch(np.array(weights).astype(np.float64), offsets,
+                    table[:,0].astype(np.int32), table[:,1].astype(np.int32),
+                    table[:,6].astype(np.float64), table[:,7].astype(np.float64),
+                    table[:,8].astype(np.float64), table[:,9].astype(np.float64),
+                    table[:,10].astype(np.float64), variations)
+
+def ReadEventBatches(filename, batch_size = 50000, start = None, stop = None, num_weights = None):
+    # Yield the events of a file (or of the byte range [start, stop) of it) as
+    # LHEBatch objects of batch_size events, with num_weights weight
+    # variations if asked for. A warm cache entry is used instead of the text
+    # when the whole file is asked for.
+    cached = OpenLHECache(filename) if start is None and stop is None else None
+    if cached is not None and (num_weights is None or cached.weights.shape[1] >= num_weights):
+        for batch in cached.batches(batch_size, num_weights):
+            yield batch
+        return
+    events = []
+    with LHEReader(filename, start=start, stop=stop) as reader:
+        for event in reader.events():
+            events.append(event)
+            if len(events) == batch_size:
+                yield EventBatch(events, num_weights)
+                events = []
+    if events:
+        yield EventBatch(events, num_weights)
+
+#--------------Columnar cache-----------------------------------------------
+# Parsed events are kept as memory-mappable .npy columns in one directory per
+# file under CACHE_DIR, keyed by the absolute path, size and mtime of the LHE
+# file, so a changed file simply misses. Entries are used most recently
+# first and the least recently used ones are removed once the cache grows
+# beyond CACHE_BUDGET bytes. Both can be set through the environment.
+CACHE_DIR = os.environ.get('LHE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.lhe_cache'))
+CACHE_BUDGET = int(float(os.environ.get('LHE_CACHE_BUDGET', 20e9)))
+CACHE_COLUMNS = ('offsets', 'pid', 'status', 'px', 'py', 'pz', 'e', 'm')
+
+def CacheKey(filename):
+    stat = os.stat(filename)
+    key = '{0}|{1}|{2!r}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class LHECacheEntry( object ):
+
+    ##
+    # @short One warm cache entry, every column is memory-mapped on access
+    #
+    # weights is the (events x (1 + number of #new weights)) matrix with
+    # XWGTUP in the first column, the particle columns are the ones of
+    # LHEBatch for the whole file.
+    def __init__( self, path ):
+        self.path = path
+
+    def column( self, name ):
+        return np.load(os.path.join(self.path, name+'.npy'), mmap_mode='r')
+
+    @property
+    def weights( self ):
+        return self.column('weights')
+
+    @property
+    def nevents( self ):
+        return self.weights.shape[0]
+
+    def batches( self, batch_size = 50000, num_weights = None ):
+        # The cached file as LHEBatch objects of batch_size events
+        weights = self.weights
+        columns = dict((name, self.column(name)) for name in CACHE_COLUMNS)
+        offsets = columns['offsets']
+        for first in range(0, weights.shape[0], batch_size):
+            last = min(first+batch_size, weights.shape[0])
+            lo, hi = offsets[first], offsets[last]
+            variations = np.array(weights[first:last, :num_weights]) if num_weights else None
+            yield LHEBatch(np.array(weights[first:last, 0]), np.array(offsets[first:last+1]-lo),
+                           *[np.array(columns[name][lo:hi]) for name in CACHE_COLUMNS[1:]],
+                           weights=variations)
+
+def OpenLHECache(filename, cache_dir = None):
+    # The warm cache entry of filename, or None. Opening an entry marks it as
+    # recently used.
+    path = os.path.join(cache_dir or CACHE_DIR, CacheKey(filename))
+    if not os.path.isdir(path): return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return LHECacheEntry(path)
+
+def BuildLHECache(filename, cache_dir = None, batch_size = 50000):
+    # Parse filename once and store it in the cache. The entry is written
+    # into a temporary directory and renamed into place when it is complete.
+    # Returns the LHECacheEntry.
+    cache_dir = cache_dir or CACHE_DIR
+    path = os.path.join(cache_dir, CacheKey(filename))
+    if os.path.isdir(path): return LHECacheEntry(path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir): raise
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+    os.mkdir(tmp_path)
+    try:
+        writers = dict((name, NpyWriter(os.path.join(tmp_path, name+'.npy'), dtype))
+                       for name, dtype in zip(CACHE_COLUMNS, (np.int64, np.int32, np.int32) + (np.float64,)*5))
+        weights = None
+        num_weights = None
+        events = []
+        tokens = []
+        nparticles = 0
+        writers['offsets'].fill(np.zeros((1,), dtype=np.int64))
+        with LHEReader(filename) as reader:
+            for event in itertools.chain(reader.events(), [None]):
+                if event is not None:
+                    if num_weights is None:
+                        num_weights = 1+len(event.new_weights)
+                        weights = NpyWriter(os.path.join(tmp_path, 'weights.npy'), np.float64, num_weights)
+                    events.append(event)
+                    tokens.extend(EventWeights(event, num_weights))
+                    if len(events) < batch_size: continue
+                if not events: break
+                batch = EventBatch(events)
+                weights.fill(np.array(tokens).astype(np.float64).reshape(-1, num_weights))
+                writers['offsets'].fill(batch.offsets[1:]+nparticles)
+                nparticles += int(batch.offsets[-1])
+                for name in CACHE_COLUMNS[1:]:
+                    writers[name].fill(getattr(batch, name))
+                events = []
+                tokens = []
+        if weights is None:
+            weights = NpyWriter(os.path.join(tmp_path, 'weights.npy'), np.float64, 1)
+        for writer in list(writers.values()) + [weights]:
+            writer.close()
+        with open(os.path.join(tmp_path, 'source.txt'), 'w') as f:
+            f.write(os.path.abspath(filename)+'\n')
+        os.rename(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path): raise
+    return LHECacheEntry(path)
+
+def EvictLHECache(budget = None, cache_dir = None):
+    # Remove the least recently used entries until the cache fits into budget
+    # bytes. Returns the number of entries removed.
+    cache_dir = cache_dir or CACHE_DIR
+    if budget is None: budget = CACHE_BUDGET
+    if not os.path.isdir(cache_dir): return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if '.tmp' in name or not os.path.isdir(path): continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.stat(path).st_mtime, size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if total <= budget: break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+#--------------Parton-level histograms--------------------------------------
+class MultiWeightHistogram( object ):
+
+    ##
+    # @short Fixed-bin histogram filled for all weight variations at once
+    #
+    # sumw and sumw2 are (variations x (nbins+2)) arrays, column 0 is the
+    # underflow and column nbins+1 the overflow as in ROOT. fill() bins the
+    # values once and accumulates every variation with a single bincount over
+    # the flattened (variation, bin) index. nevents counts all events passed
+    # to fill(), including those without a value, so sumw/nevents is the
+    # cross-section per bin. Histograms of the same binning are added with
+    # add(), e.g. to combine files handled by different processes.
+    def __init__( self, nbins, low, high, num_variations ):
+        self.edges = np.linspace(low, high, nbins+1)
+        self.nevents = 0
+        self.sumw = np.zeros((num_variations, nbins+2), dtype=np.float64)
+        self.sumw2 = np.zeros((num_variations, nbins+2), dtype=np.float64)
+
+    @property
+    def nbins( self ):
+        return len(self.edges)-1
+
+    def fill( self, values, weights, nevents = None ):
+        # values has one entry per event (NaN where the observable is not
+        # defined), weights is (events x variations)
+        self.nevents += len(values) if nevents is None else nevents
+        keep = ~np.isnan(values)
+        values, weights = values[keep], weights[keep]
+        if len(values) == 0: return
+        nvar, width = self.sumw.shape
+        bins = np.searchsorted(self.edges, values, side='right')	# high itself is overflow, as in ROOT
+        index = (bins[:,None] + width*np.arange(nvar)[None,:]).ravel()
+        weights = weights.ravel()
+        self.sumw += np.bincount(index, weights=weights, minlength=nvar*width).reshape(nvar, width)
+        self.sumw2 += np.bincount(index, weights=weights*weights, minlength=nvar*width).reshape(nvar, width)
+
+    def add( self, other ):
+        self.nevents += other.nevents
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+def _Leading(event_index, nevents, pt, select):
+    # Index of the highest and second highest pt particle among the selected
+    # ones in every event, -1 where there is none
+    particles = np.nonzero(select)[0]
+    events = event_index[particles]
+    order = np.lexsort((-pt[particles], events))
+    particles, events = particles[order], events[order]
+    counts = np.bincount(events, minlength=nevents)
+    first = np.zeros((nevents,), dtype=np.int64)
+    np.cumsum(counts[:-1], out=first[1:])
+    leading = np.full((nevents, 2), -1, dtype=np.int64)
+    for k in (0, 1):
+        has = counts > k
+        leading[has, k] = particles[first[has]+k]
+    return leading
+
+def PartonObservables(batch):
+    # Parton-level observables of an LHEBatch, one entry per event and NaN
+    # where an event has fewer than two jets (or no lepton for the W):
+    # jets are final-state quarks and gluons, the W is the sum of the
+    # final-state leptons and neutrinos.
+    nevents = batch.nevents
+    event_index = np.repeat(np.arange(nevents), batch.nparticles)
+    final = batch.status == 1
+    apid = np.abs(batch.pid)
+    pt = np.hypot(batch.px, batch.py)
+    jets = _Leading(event_index, nevents, pt, final & ((apid <= 5) | (apid == 21)))
+    two = jets[:,1] >= 0
+    j1, j2 = jets[two,0], jets[two,1]
+    e = batch.e[j1]+batch.e[j2]
+    px = batch.px[j1]+batch.px[j2]
+    py = batch.py[j1]+batch.py[j2]
+    pz = batch.pz[j1]+batch.pz[j2]
+    rapidity = lambda i: 0.5*np.log((batch.e[i]+batch.pz[i])/(batch.e[i]-batch.pz[i]))
+    observables = {}
+    for name in ('mjj', 'dyjj', 'ptj1', 'htjj', 'ptw'):
+        observables[name] = np.full((nevents,), np.nan)
+    observables['mjj'][two] = np.sqrt(np.maximum(e*e-px*px-py*py-pz*pz, 0.0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observables['dyjj'][two] = np.abs(rapidity(j1)-rapidity(j2))
+    observables['ptj1'][two] = pt[j1]
+    observables['htjj'][two] = pt[j1]+pt[j2]
+    leptons = final & (apid >= 11) & (apid <= 16)
+    nleptons = np.bincount(event_index[leptons], minlength=nevents)
+    wpx = np.bincount(event_index[leptons], weights=batch.px[leptons], minlength=nevents)
+    wpy = np.bincount(event_index[leptons], weights=batch.py[leptons], minlength=nevents)
+    observables['ptw'][nleptons > 0] = np.hypot(wpx, wpy)[nleptons > 0]
+    return observables
+
+def FillPartonHistograms(filename, definitions, num_weights, start = None, stop = None, batch_size = 50000):
+    # One pass over a file (or a byte range of it) filling a
+    # MultiWeightHistogram for every (name, observable, nbins, low, high) in
+    # definitions with num_weights weight variations. Returns {name: histogram}
+    # and the XSAccumulator of all events, for the total cross-sections.
+    histograms = dict((name, MultiWeightHistogram(nbins, low, high, num_weights))
+                      for name, observable, nbins, low, high in definitions)
+    total = XSAccumulator(num_weights)
+    for batch in ReadEventBatches(filename, batch_size, start, stop, num_weights):
+        observables = PartonObservables(batch)
+        for name, observable, nbins, low, high in definitions:
+            histograms[name].fill(observables[observable], batch.weights)
+        total.fill(batch.weights)
+    return histograms, total
+
+#--------------Integrity scan-----------------------------------------------
+SCAN_TAGS = (b'<event>', b'</event>', b'</LesHouchesEvents>')
+MAX_HEADER_SIZE = 1 << 24	# the <init> block has to start within the first 16 MB
+
+class _HashingReader( object ):
+
+    ##
+    # @short File wrapper that feeds everything read through a hash
+    def __init__( self, fileobj, digest ):
+        self._file = fileobj
+        self.digest = digest
+
+    def read( self, size = -1 ):
+        data = self._file.read(size)
+        self.digest.update(data)
+        return data
+
+def _GunzipChunks(raw, chunk_size):
+    # Decompress a (possibly multi-member) gzip stream chunk by chunk
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while True:
+        data = raw.read(chunk_size)
+        if not data: break
+        out = decompressor.decompress(data)
+        while decompressor.unused_data:
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            out += decompressor.decompress(rest)
+        if out: yield out
+
+def _ReadChunks(reader, chunk_size):
+    while True:
+        data = reader.read(chunk_size)
+        if not data: break
+        yield data
+
+def ScanLHE(filename, chunk_size = CHUNK_SIZE):
+    # Check one file in a single read from disk: the md5 of the file as stored
+    # (the same as List_md5.py), the number of complete events, whether the
+    # last event is cut off or </LesHouchesEvents> is missing, and whether the
+    # <init> block has its cross-section set. Compressed files are hashed as
+    # they are and checked after decompression. Returns a dict for the report,
+    # problems lists everything that is wrong with the file.
+    digest = hashlib.md5()
+    raw = open(filename, 'rb')
+    reader = _HashingReader(raw, digest)
+    tar = None
+    try:
+        if filename.endswith('.tar.gz') or filename.endswith('.tgz'):
+            tar = tarfile.open(fileobj=reader, mode='r|gz')
+            member = None
+            for member in tar:
+                if member.isfile() and member.name.endswith(LHE_EXTENSIONS): break
+            else:
+                member = None
+            chunks = _ReadChunks(tar.extractfile(member), chunk_size) if member is not None else iter([])
+        elif filename.endswith('.gz'):
+            chunks = _GunzipChunks(reader, chunk_size)
+        else:
+            chunks = _ReadChunks(reader, chunk_size)
+
+        counts = [0]*len(SCAN_TAGS)
+        last = [-1]*len(SCAN_TAGS)
+        keep = max(len(tag) for tag in SCAN_TAGS)-1
+        carry = b''
+        base = 0		# offset of carry[0] in the decompressed text
+        header = b''
+        for data in chunks:
+            buf = carry + data
+            for k, tag in enumerate(SCAN_TAGS):
+                # Tags lying completely inside the carry were counted last time
+                found = buf.count(tag, max(0, len(carry)-len(tag)+1))
+                if found:
+                    counts[k] += found
+                    last[k] = base + buf.rfind(tag)
+            if header is not None:
+                header += data
+                if b'</init>' in header or len(header) > MAX_HEADER_SIZE:
+                    header = header[:header.find(b'</init>')+len(b'</init>')] if b'</init>' in header else b''
+                    init_text, header = header, None
+            carry = buf[-keep:] if len(buf) > keep else buf
+            base += len(buf)-len(carry)
+        # Whatever follows the LHE member of a tarball still goes into the checksum
+        while reader.read(chunk_size): pass
+    finally:
+        if tar is not None: tar.close()
+        raw.close()
+    if header is not None: init_text = header if b'</init>' in header else b''
+
+    # Every byte of the raw file went through the hashing reader above
+    result = {'file': filename, 'size': os.path.getsize(filename), 'md5': digest.hexdigest(),
+              'events': counts[1], 'truncated': last[0] > last[1],
+              'closed': last[2] >= 0 and last[2] > max(last[0], last[1]),
+              'xsecup': [], 'xerrup': [], 'problems': []}
+    start_init = init_text.rfind(b'<init>')
+    problems = result['problems']
+    if start_init >= 0:
+        try:
+            init = LHEInit(init_text[init_text.rfind(b'\n', 0, start_init)+1:])
+            result['xsecup'] = [process[0] for process in init.processes]
+            result['xerrup'] = [process[1] for process in init.processes]
+        except (ValueError, IndexError):
+            problems.append('unreadable <init> block')
+    if start_init < 0: problems.append('no <init> block')
+    elif not result['xsecup'] or min(result['xsecup']) <= 0: problems.append('XSECUP not set')
+    if result['truncated']: problems.append('truncated last event')
+    if counts[0]-counts[1] not in (0, 1): problems.append('unbalanced <event> tags')
+    if not result['closed']: problems.append('missing </LesHouchesEvents>')
+    return result
+
+#--------------Checkpoints--------------------------------------------------
+CHECKPOINT_SUFFIX = '.ckpt'
+CHECKPOINT_BYTES = 1 << 28	# input read between two checkpoints
+
+def CheckpointName(filename, tool, start = None):
+    # <file>.<tool>.ckpt next to the input, <file>.<tool>.<start>.ckpt for
+    # the byte range of it that begins at start
+    if start is None: return '{0}.{1}{2}'.format(filename, tool, CHECKPOINT_SUFFIX)
+    return '{0}.{1}.{2}{3}'.format(filename, tool, start, CHECKPOINT_SUFFIX)
+
+def SaveCheckpoint(name, filename, state):
+    # Store state (a dict of plain values) for the input filename. It is
+    # written to a temporary file and renamed into place, so a crash leaves
+    # either the previous checkpoint or the new one. Outputs have to be
+    # synced to disk before their sizes go into state.
+    stat = os.stat(filename)
+    state = dict(state, file=os.path.abspath(filename), size=stat.st_size, mtime=stat.st_mtime)
+    tmp_name = name+'.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_name, name)
+
+def LoadCheckpoint(name, filename):
+    # The state stored by SaveCheckpoint, or None if there is none or the
+    # input file has changed since
+    if not os.path.isfile(name): return None
+    try:
+        stat = os.stat(filename)
+        with open(name) as f:
+            state = json.load(f)
+        if state['size'] != stat.st_size or state['mtime'] != stat.st_mtime: return None
+        return state
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def RemoveCheckpoints(filename, tool):
+    # Remove all checkpoints of tool for filename, whole file and byte ranges
+    directory = os.path.dirname(filename) or '.'
+    prefix = os.path.basename(filename)+'.'+tool+'.'
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith((CHECKPOINT_SUFFIX, CHECKPOINT_SUFFIX+'.tmp')):
+            os.remove(os.path.join(directory, name))
+
+class CheckpointOutput( object ):
+
+    ##
+    # @short Output file that can be cut back to its last checkpoint
+    #
+    # sync() puts everything written so far on disk and returns the size of
+    # the file, which is what goes into a checkpoint. Opened again with that
+    # size, the file is truncated back to it and written on from there, so a
+    # resumed run gives the same bytes as one that never stopped. Gzipped
+    # output is written as one gzip member per checkpoint (without a
+    # timestamp), which still decompresses as a single stream. The member
+    # boundaries follow the checkpoints, so the compressed bytes are only the
+    # same for runs that checkpoint at the same places.
+    def __init__( self, filename, compress = False, size = None ):
+        if compress and not filename.endswith('.gz'): filename += '.gz'
+        self.name = filename
+        self._compress = compress
+        self._member = None
+        if size is None:
+            self._file = open(filename, 'wb')
+        else:
+            self._file = open(filename, 'r+b')
+            self._file.truncate(size)
+            self._file.seek(size)
+
+    def write( self, data ):
+        if not self._compress: return self._file.write(data)
+        if self._member is None:
+            self._member = gzip.GzipFile('', 'wb', GZIP_LEVEL, self._file, 0)
+        self._member.write(data)
+
+    def writelines( self, lines ):
+        self.write(b''.join(lines))
+
+    def sync( self ):
+        if self._member is not None:
+            self._member.close()
+            self._member = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close( self ):
+        self.sync()
+        self._file.close()
@@ -1,12 +1,24 @@
 import glob
 import os
+import sys
+import time
+import traceback
+import subprocess
 from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
 from Aux_Functions import *
+from aidamerge import MergeAidaModes, MergeAida, AidaToTH1s
 
 parser = OptionParser(usage="%prog <options>")
 parser.add_option("-s", "--skip-merged",
                   action="store_true", dest="skipMerged", default=False,
                   help="Skip the folders that already have merged aida files.")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(),
+                  help="Number of processes each merge reads the aida files on (default is the number of cores). Only used without -p.")
+parser.add_option("-p", "--parallel", type="int", dest="parallel", default=1,
+                  help="Number of dataset folders merged at the same time (default is 1). With more than one, every folder is merged in a single process of the pool.")
+parser.add_option("-r", "--root-output", dest="rootOutput", default="",
+                  help="Compile the merged histograms straight into this ROOT file (e.g. VBF_Systematics.root, as CompileRootFiles.py does) instead of writing a <run>.root and <run>_add.root per folder with aida2root.")
 opts, args = parser.parse_args()
 
 dataset_names = GetListDataset('dataset_names')
@@ -15,173 +27,175 @@ powheg_w2jet_list = ['000001','000002','000003','000004','000005','000006','0000
 powheg_w2jet_list_7TeV = ['000008','000009','000010','000011','000012','000013','000014']
 powheg_vbfw_list  = ['000015','000016','000017','000018','000019','000020','000021']
 powheg_vbfw_list_7TeV  = ['000022','000023','000024','000025','000026','000027','000028']
-powheg_dict = dict(zip(dataset_number, dataset_names))
 
-# Make a list of Aida files available in the current directory
-for folder in dataset_names:
-    current_dir = folder+"/"
-    if os.path.exists(current_dir) != True: continue
+# Run number -> folder name
+powheg_dict = dict((name.split('.')[0], name) for name in dataset_names)
+
+# Powheg W+- folders made from a W- and a W+ folder: (source_Wm, source_Wp)
+powheg_wpm_sources = {"000029": ("185836", "185837"), "000030": ("185847", "185848"),
+                      "000031": ("185930", "185931"), "000032": ("185946", "185947")}
+for folder_list, offset in ((powheg_w2jet_list, 185695), (powheg_vbfw_list, 185834),
+                            (powheg_w2jet_list_7TeV, 185924), (powheg_vbfw_list_7TeV, 185926)):
+    for number in folder_list:
+        source_Wm = str(int(number) + offset)
+        powheg_wpm_sources[number] = (source_Wm, str(int(source_Wm) + 7))
+
+base_dir = os.getcwd()
+
+def sourceFolders(folder):
+    # The W- and W+ folders a Powheg W+- folder is made from
     file_name = folder.split('.')[0]
-    
-    os.chdir(current_dir)
-    if opts.skipMerged:
-        file_exists = os.path.isfile(file_name+".root")
-        if file_exists:
-            os.chdir("..")
-            continue
-        
-    Aida_Files = glob.glob("*.aida*")
-    i = len(Aida_Files)
-    print "There were {0} in the directory: {1}".format(i,current_dir)
-
-    if file_name in powheg_w2jet_list:
-        dest_Wpm = file_name
-        source_Wm = str(int(file_name) + 185695)
-        source_Wp = str(int(source_Wm) + 7)
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name in powheg_vbfw_list:
-        dest_Wpm = file_name
-        source_Wm = str(int(file_name) + 185834)
-        source_Wp = str(int(source_Wm) + 7)
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name in powheg_w2jet_list_7TeV:
-        dest_Wpm = file_name
-        source_Wm = str(int(file_name) + 185924)
-        source_Wp = str(int(source_Wm) + 7)
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name in powheg_vbfw_list_7TeV:
-        dest_Wpm = file_name
-        source_Wm = str(int(file_name) + 185926)
-        source_Wp = str(int(source_Wm) + 7)
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name == "000029":
-        source_Wm = "185836"
-        source_Wp = "185837"
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name == "000030":
-        source_Wm = "185847"
-        source_Wp = "185848"
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name == "000031":
-        source_Wm = "185930"
-        source_Wp = "185931"
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    elif file_name == "000032":
-        source_Wm = "185946"
-        source_Wp = "185947"
-        source_Wm_dir = powheg_dict[source_Wm]
-        source_Wp_dir = powheg_dict[source_Wp]
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wm.aida".format(source_Wm_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_add.save ./merged_add_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        cmd = "cp ../{0}/merged_avg.save ./merged_avg_Wp.aida".format(source_Wp_dir)
-        os.system(cmd)
-        os.system("python ../aidamerge.py -c -o merged_avg.aida merged_avg_Wm.aida merged_avg_Wp.aida")
-        os.system("python ../aidamerge.py -s -o merged_add.aida merged_add_Wm.aida merged_add_Wp.aida")
-    else:
-        if not Aida_Files: continue
-        # Run aidamerge.py over every file in the Aida_Files list.
-        arguments = "%s" % " ".join(map(str, Aida_Files))
-        cmd = "python ../aidamerge.py -o merged_avg.aida "+arguments
-        os.system(cmd)
-        cmd = "python ../aidamerge.py -s -o merged_add.aida "+arguments
-        os.system(cmd)
-		
-    # Convert merged.aida file to merged.root file and rename to dataset
-    # run number (found from the folder name).
-    os.system("aida2root merged_avg.aida")
-    os.system("aida2root merged_add.aida")
-    #if "Powheg" in file_name: file_name = folder.replace('.','_')
-    cmd = "mv merged_avg.root "+file_name+".root"
-    os.system(cmd)
-    cmd = "mv merged_add.root "+file_name+"_add.root"
-    os.system(cmd)
-		
-    # Remove the merged.aida file in case the script fails.
-    # This keeps you from having to delete them by hand before re-running script.
-    os.system("mv merged_add.aida merged_add.save")
-    os.system("mv merged_avg.aida merged_avg.save")
-	
-    # Prepare for next folder
-    os.chdir("..")
-    Aida_Files = []
+    if file_name not in powheg_wpm_sources: return []
+    return [powheg_dict.get(number, number) for number in powheg_wpm_sources[file_name]]
+
+def runCommand(cmd, directory):
+    if subprocess.call(cmd, cwd=directory) != 0:
+        raise RuntimeError("'{0}' failed in {1}".format(" ".join(cmd), directory))
+
+def mergeFolder(task):
+    # Merge the aida files of one dataset folder into merged_avg.save and
+    # merged_add.save, plus <run>.root and <run>_add.root with aida2root
+    # unless the histograms are compiled with -r. Everything uses absolute
+    # paths, so folders can be merged side by side. Never raises, returns
+    # (folder, error message or None, seconds, number of input files, merged)
+    # where merged holds (histos_avg, avg_mode, histos_add) for -r.
+    folder, jobs = task
+    start = time.time()
+    try:
+        directory = os.path.join(base_dir, folder)
+        file_name = folder.split('.')[0]
+        out_avg = os.path.join(directory, "merged_avg.aida")
+        out_add = os.path.join(directory, "merged_add.aida")
+        sources = sourceFolders(folder)
+        if sources:
+            # W+- from the merged W- and W+ folders
+            inputs_avg = [os.path.join(base_dir, source, "merged_avg.save") for source in sources]
+            inputs_add = [os.path.join(base_dir, source, "merged_add.save") for source in sources]
+            for name in inputs_avg+inputs_add:
+                if not os.path.isfile(name): raise IOError("Missing W+- source {0}".format(name))
+            avg_mode = 'channels'
+            histos_avg = MergeAidaModes(inputs_avg, [(out_avg,avg_mode)])
+            histos_add = MergeAidaModes(inputs_add, [(out_add,'sum')])
+            nfiles = len(sources)
+        else:
+            Aida_Files = sorted(glob.glob(os.path.join(directory, "*.aida*")))
+            if not Aida_Files: return folder, None, time.time()-start, 0, None
+            # Merge every file in the Aida_Files list once, averaged and added.
+            avg_mode = 'avg'
+            histos_avg = histos_add = MergeAidaModes(Aida_Files, [(out_avg,avg_mode), (out_add,'sum')], jobs)
+            nfiles = len(Aida_Files)
+
+        merged = None
+        if opts.rootOutput:
+            merged = (histos_avg, avg_mode, histos_add)
+        else:
+            # Convert merged.aida file to merged.root file and rename to dataset
+            # run number (found from the folder name).
+            runCommand(["aida2root", "merged_avg.aida"], directory)
+            runCommand(["aida2root", "merged_add.aida"], directory)
+            os.rename(os.path.join(directory, "merged_avg.root"), os.path.join(directory, file_name+".root"))
+            os.rename(os.path.join(directory, "merged_add.root"), os.path.join(directory, file_name+"_add.root"))
+
+        # Rename the merged.aida files so they are not merged again next time
+        os.rename(out_add, os.path.join(directory, "merged_add.save"))
+        os.rename(out_avg, os.path.join(directory, "merged_avg.save"))
+        return folder, None, time.time()-start, nfiles, merged
+    except Exception:
+        return folder, traceback.format_exc().strip().splitlines()[-1], time.time()-start, 0, None
+
+def runFolders(folders, parallel, jobs):
+    # Yield the mergeFolder results of all folders as they finish. A folder
+    # only starts once the folders it is made from (W+-) have finished and it
+    # fails straight away if one of them failed. With parallel > 1 up to that
+    # many folders are merged at a time on a pool, each in one process.
+    waiting = list(folders)
+    finished = set()
+    failed = set()
+    running = []
+    pool = Pool(processes=parallel) if parallel > 1 else None
+    try:
+        while waiting or running:
+            for folder in list(waiting):
+                broken = [source for source in sourceFolders(folder) if source in failed]
+                if broken:
+                    waiting.remove(folder)
+                    failed.add(folder)
+                    yield folder, "W+- source {0} failed".format(broken[0]), 0.0, 0, None
+            ready = [folder for folder in waiting
+                     if all(source in finished or source not in folders for source in sourceFolders(folder))]
+            if pool is None:
+                if not ready: break
+                waiting.remove(ready[0])
+                result = mergeFolder((ready[0], jobs))
+            else:
+                for folder in ready[:max(parallel-len(running), 0)]:
+                    waiting.remove(folder)
+                    running.append(pool.apply_async(mergeFolder, ((folder, 1),)))
+                done = [job for job in running if job.ready()]
+                if not done:
+                    if not running: break
+                    time.sleep(0.2)
+                    continue
+                running.remove(done[0])
+                result = done[0].get()
+            if result[1] is None: finished.add(result[0])
+            else: failed.add(result[0])
+            yield result
+    except:
+        if pool is not None: pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    if opts.rootOutput:
+        from CompileRootFiles import OpenCompiledFile, CompileDataset, CloseCompiledFile
+        hf, h_xsecs = OpenCompiledFile(os.path.abspath(opts.rootOutput))
+
+    # Folders that exist and still have to be merged
+    folders = []
+    saved = []
+    for folder in dataset_names:
+        directory = os.path.join(base_dir, folder)
+        if os.path.exists(directory) != True: continue
+        if opts.skipMerged:
+            if opts.rootOutput: file_exists = os.path.isfile(os.path.join(directory, "merged_avg.save")) and os.path.isfile(os.path.join(directory, "merged_add.save"))
+            else: file_exists = os.path.isfile(os.path.join(directory, folder.split('.')[0]+".root"))
+            if file_exists:
+                saved.append(folder)
+                continue
+        folders.append(folder)
+
+    start = time.time()
+    merged = {}
+    failures = []
+    for folder, error, seconds, nfiles, result in runFolders(folders, opts.parallel, opts.jobs):
+        if error is not None:
+            failures.append((folder, error))
+            print "FAILED {0} after {1:.1f} s: {2}".format(folder,seconds,error)
+        elif nfiles == 0:
+            print "{0}: no aida files".format(folder)
+        else:
+            merged[folder] = result
+            print "{0}: merged {1} files in {2:.1f} s".format(folder,nfiles,seconds)
+
+    if opts.rootOutput:
+        # Histograms go from the merged arrays straight into the dataset
+        # directory of the compiled file, no per-dataset root files. Already
+        # merged folders (-s) are compiled from their saved merge.
+        for idx, folder in enumerate(dataset_names):
+            if folder in merged:
+                histos_avg, avg_mode, histos_add = merged[folder]
+                CompileDataset(hf, h_xsecs, idx, folder, AidaToTH1s(histos_avg, avg_mode), AidaToTH1s(histos_add, 'sum'))
+            elif folder in saved:
+                directory = os.path.join(base_dir, folder)
+                CompileDataset(hf, h_xsecs, idx, folder, AidaToTH1s(MergeAida([os.path.join(directory, "merged_avg.save")])),
+                               AidaToTH1s(MergeAida([os.path.join(directory, "merged_add.save")]), 'sum'))
+        CloseCompiledFile(hf, h_xsecs)
+        print "Compiled the merged histograms into {0}".format(opts.rootOutput)
+
+    print "Merged {0} of {1} folders in {2:.1f} s, {3} skipped, {4} failed.".format(len(merged),len(folders),time.time()-start,len(saved),len(failures))
+    for folder, error in failures:
+        print "  {0}: {1}".format(folder,error)
+    if failures: sys.exit(1)
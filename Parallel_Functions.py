@@ -0,0 +1,54 @@
+import sys, time
+from multiprocessing import Pool, cpu_count
+
+# Process-pool driver shared by the LHE scripts (LHE_Functions.py) and the
+# AIDA merging (aidamerge.py). It only needs the standard library.
+
+def _CallWithTask(item):
+    function, task = item
+    return task, function(task)
+
+def _BoundedResults(pool, items, max_pending):
+    # Results in task order, with at most max_pending tasks handed to the
+    # pool and not yet collected by the caller
+    pending = []
+    for item in items:
+        if len(pending) >= max_pending: yield pending.pop(0).get()
+        pending.append(pool.apply_async(_CallWithTask, (item,)))
+    while pending: yield pending.pop(0).get()
+
+def RunParallel(function, tasks, jobs = None, progress = True, ordered = False, max_pending = None):
+    # Run function(task) for every task on a pool of jobs worker processes
+    # (default is one per core) and yield (task, result) pairs as they finish,
+    # so the caller can reduce the results in the parent. With ordered=True
+    # the results come back in task order instead. max_pending (ordered only)
+    # bounds the number of results held back for a slow caller, tasks are
+    # only started as earlier results are taken. function has to be
+    # defined at module level. Progress goes to stderr at most every 5 s.
+    if jobs is None: jobs = cpu_count()
+    tasks = list(tasks)
+    start = time.time()
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(jobs, len(tasks)))
+        if ordered and max_pending:
+            results = _BoundedResults(pool, [(function, task) for task in tasks], max(max_pending, 1))
+        else:
+            imap = pool.imap if ordered else pool.imap_unordered
+            results = imap(_CallWithTask, [(function, task) for task in tasks])
+    else:
+        results = (_CallWithTask((function, task)) for task in tasks)
+    last_report = start
+    try:
+        for done, result in enumerate(results, 1):
+            now = time.time()
+            if progress and (now-last_report > 5 or done == len(tasks)):
+                sys.stderr.write("[{0}/{1} done, {2:.1f} s]\n".format(done, len(tasks), now-start))
+                last_report = now
+            yield result
+    except:
+        if pool is not None: pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -6,6 +6,26 @@ for hepmc in $( ls *.hepmc ); do
 	mv Rivet.yoda ${hepmc}.yoda
 done
 
+# Usage: Rivet.sh [--lhe [weight]]
+# With --lhe the LHE files are run as well. They are converted on the fly
+# into a fifo (as in EvgentoRivet.sh), so no .hepmc file is written. The
+# weight picks the variation: Nominal, one of the changeEventWeight.py
+# folder names or the #new weight line number (default is $WEIGHT or Nominal).
+if [ "$1" == "--lhe" ]; then
+	SCRIPT_DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
+	WEIGHT=${2:-${WEIGHT:-Nominal}}
+	for lhe in *.lhe; do
+		[ -e "${lhe}" ] || continue
+		rm -f hepmc.fifo
+		mkfifo hepmc.fifo
+		python "${SCRIPT_DIR}/lhe2hepmc.py" -w "${WEIGHT}" "${lhe}" hepmc.fifo &
+		rivet -a WJETS_SYST_NEWANALYSIS hepmc.fifo
+		wait
+		mv Rivet.yoda "${lhe%.lhe}_${WEIGHT}.yoda"
+	done
+	rm -f hepmc.fifo
+fi
+
 # # For W2jets - Background
 # xsec=( 5228.18638778672 7497.65468562505 3652.66944215 3539.19590298 )
 # index=0
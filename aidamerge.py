@@ -1,9 +1,12 @@
 #! /usr/bin/env python
 
-import sys, os, copy
-from math import sqrt
-from subprocess import Popen
-import lighthisto
+import sys, os
+import numpy as np
+from array import array
+from xml.sax.saxutils import quoteattr
+from multiprocessing import cpu_count
+from Parallel_Functions import RunParallel
+from Exact_Functions import ExactColumnSums, ExactToFloat
 
 ## Try to load faster but non-standard cElementTree module
 try:
@@ -18,80 +21,255 @@ except ImportError:
             sys.stderr.write("Can't load the ElementTree XML parser: please install it!\n")
             sys.exit(1)
 
-from optparse import OptionParser
-parser = OptionParser(usage="%prog aidafile [aidafile2 ...]")
-parser.add_option("-o", "--outfile", dest="OUTFILE",
-                  default="merged.aida", help="file for merged aida output.")
-parser.add_option("-s", "--sum",
-                  action="store_true", dest="performSum", default=False,
-                  help="sum the bin values instead of averaging")
-parser.add_option("-c", "--sum-channels",
-                  action="store_true", dest="sumChannels", default=False,
-                  help="sum the bin values instead of averaging but average errors")
-opts, args = parser.parse_args()
-headerprefix = ""
+# Merges the dataPointSets of several AIDA files bin by bin. Each file is read
+# with iterparse one dataPointSet at a time and folded into running sums, so
+# only one input histogram is held besides the merged output. The
+# merged histograms are written as AIDA straight away, without flat2aida.
+#
+# The sums are exact (see ExactColumnSums in Exact_Functions.py), so partial
+# merges of groups of files can be done in a process pool and added together
+# in any grouping with the same result as one serial merge.
 
-if len(args) < 1:
-    sys.stderr.write("Must specify at least one AIDA histogram file\n")
-    sys.exit(1)
+AIDA_HEADER = '''<?xml version="1.0" encoding="ISO-8859-1" ?>
+<!DOCTYPE aida SYSTEM "http://aida.freehep.org/schemas/3.3/aida.dtd">
+<aida version="3.3">
+  <implementation version="1.1" package="FreeHEP"/>
+'''
+AIDA_FOOTER = '</aida>\n'
 
+#-----Merge modes-----
+# avg:      mean of the bin values, errors added in quadrature and divided by n
+# sum:      bin values and errors summed (-s)
+# channels: bin values summed, errors as for avg (-c, e.g. W- + W+)
+MODES = ('avg', 'sum', 'channels')
 
-try:
-    outaida = open(opts.OUTFILE, "w")
-except:
-    sys.stderr.write("Couldn't open outfile %s for writing." % opts.OUTFILE)
+class AidaHisto( object ):
 
-try:
-    outdat = open(opts.OUTFILE.replace(".aida", ".dat"), "w")
-except:
-    sys.stderr.write("Couldn't open outfile %s for writing." % opts.OUTFILE.replace(".aida", ".dat"))
-
-## Get histos
-inhistos = {}
-weights = {}
-for aidafile in args:
-    tree = ET.parse(aidafile)
-    for dps in tree.findall("dataPointSet"):
-        h = lighthisto.Histo.fromDPS(dps)
-        if not inhistos.has_key(h.fullPath()):
-            inhistos[h.fullPath()] = {}
-        inhistos[h.fullPath()][aidafile] = h
-
-## Merge histos
-outhistos = {}
-for path, hs in inhistos.iteritems():
-    #print path, hs
-    outhistos[path] = copy.deepcopy(hs.values()[0])
-    for i, b in enumerate(outhistos[path].getBins()):
-        sum_val = 0.0
-        sum_err2 = 0.0
-        n = 0
-        for infile, h in hs.iteritems():
-            sum_val += h.getBin(i).val
-            try:
-                sum_err2 += h.getBin(i).getErr()**2
-            except OverflowError:
-                # in case the **2 produces overflow errors
-                # set sum to 'inf'
-                sum_err2 = float('inf')
-            n += 1
-        if (opts.performSum or opts.sumChannels): outhistos[path].getBin(i).val = sum_val
-        else:                 outhistos[path].getBin(i).val = sum_val / n
+    ##
+    # @short Running sums of one histogram path over the merged files
+    #
+    # The bin layout (the x measurements), title and axis labels are those of
+    # the first file the path was found in. val and err2 are the sums of the
+    # bin values and of the squared bin errors and n is the number of files
+    # that had the histogram.
+    #
+    # Every filled histogram is added to exact integer sums straight away.
+    # inf and nan do not fit into those and are summed on their own, which
+    # does not depend on the order either.
+    def __init__( self, path, name, title, xlabel, ylabel, x ):
+        self.path = path
+        self.name = name
+        self.title = title
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.x = x
+        self.n = 0
+        self.exact_val = [0]*len(x)
+        self.exact_err2 = [0]*len(x)
+        self.special_val = np.zeros(len(x))
+        self.special_err2 = np.zeros(len(x))
 
-        try:
-            if (opts.performSum): outhistos[path].getBin(i).setErr(sum_err2**0.5 )
-            else:                 outhistos[path].getBin(i).setErr(sum_err2**0.5 / n)
-        except OverflowError:
-            # to get back to numerics, replace an eventual 'inf' 
-            # in sum_err2 with max float available ~1.e+308
-            outhistos[path].getBin(i).setErr(1.e308)
-
-## Write out merged histos
-#print sorted(outhistos.values())
-outdat.write("\n\n".join([h.asFlat() for h in sorted(outhistos.values())]))
-outdat.write("\n")
-outdat.close()
-
-Popen(["flat2aida", opts.OUTFILE.replace(".aida", ".dat")], stdout=outaida).wait()
-
-os.unlink(opts.OUTFILE.replace(".aida", ".dat"))
+    @property
+    def fullPath( self ):
+        return self.path+"/"+self.name
+
+    @property
+    def nbins( self ):
+        return len(self.x)
+
+    @property
+    def val( self ):
+        return self._total(self.exact_val, self.special_val)
+
+    @property
+    def err2( self ):
+        return self._total(self.exact_err2, self.special_err2)
+
+    def _total( self, exact, special ):
+        total = np.array([ExactToFloat(value) for value in exact], dtype=np.float64)
+        return np.where(special != 0, special, total)
+
+    def fill( self, val, err2 ):
+        # Add the bins of one more file
+        if len(val) != self.nbins:
+            raise ValueError("{0} has {1} bins, expected {2}".format(self.fullPath, len(val), self.nbins))
+        for values, exact, special in ((val, self.exact_val, self.special_val), (err2, self.exact_err2, self.special_err2)):
+            values = np.asarray(values, dtype=np.float64)
+            finite = np.isfinite(values)
+            sums = ExactColumnSums(np.where(finite, values, 0.0)[None,:])
+            for i, value in enumerate(sums): exact[i] += value
+            if not finite.all(): special += np.where(finite, 0.0, values)
+        self.n += 1
+
+    def add( self, other ):
+        # Add the sums of another partial merge of the same path
+        if other.nbins != self.nbins:
+            raise ValueError("{0} has {1} bins, expected {2}".format(self.fullPath, other.nbins, self.nbins))
+        self.exact_val = [a+b for a, b in zip(self.exact_val, other.exact_val)]
+        self.exact_err2 = [a+b for a, b in zip(self.exact_err2, other.exact_err2)]
+        self.special_val += other.special_val
+        self.special_err2 += other.special_err2
+        self.n += other.n
+        return self
+
+    def merged( self, mode = 'avg' ):
+        # Merged (values, errors) arrays
+        with np.errstate(over='ignore'):
+            err = np.sqrt(self.err2)
+        if mode == 'sum': return self.val, err
+        if mode == 'channels': return self.val, err/self.n
+        return self.val/self.n, err/self.n
+
+    def asAIDA( self, mode = 'avg' ):
+        # The merged histogram as an AIDA dataPointSet, laid out like flat2aida
+        val, err = self.merged(mode)
+        lines = ['  <dataPointSet name=%s dimension="2"\n' % quoteattr(self.name),
+                 '    path=%s title=%s>\n' % (quoteattr(self.path), quoteattr(self.title))]
+        if self.xlabel: lines.append('    <dimension dim="0" title=%s />\n' % quoteattr(self.xlabel))
+        if self.ylabel: lines.append('    <dimension dim="1" title=%s />\n' % quoteattr(self.ylabel))
+        lines.append('    <annotation>\n')
+        lines.append('      <item key="Title" value=%s sticky="true"/>\n' % quoteattr(self.title))
+        lines.append('      <item key="AidaPath" value=%s sticky="true"/>\n' % quoteattr(self.fullPath))
+        lines.append('      <item key="FullPath" value=%s sticky="true"/>\n' % quoteattr(self.fullPath))
+        lines.append('    </annotation>\n')
+        for (xval, xplus, xminus), yval, yerr in zip(self.x, val, err):
+            lines.append('    <dataPoint>\n')
+            lines.append('      <measurement value="%e" errorPlus="%e" errorMinus="%e"/>\n' % (xval, xplus, xminus))
+            lines.append('      <measurement value="%e" errorPlus="%e" errorMinus="%e"/>\n' % (yval, yerr, yerr))
+            lines.append('    </dataPoint>\n')
+        lines.append('  </dataPointSet>\n')
+        return "".join(lines)
+
+    def binEdges( self ):
+        # Lower edge of every bin and the upper edge of the last one
+        return list(self.x[:,0]-self.x[:,2]) + [self.x[-1,0]+self.x[-1,1]]
+
+    def asTH1( self, mode = 'avg', name = None ):
+        # The merged histogram as a ROOT TH1D (named after the dataPointSet,
+        # like aida2root does), not attached to any directory. Needs PyROOT.
+        import ROOT
+        val, err = self.merged(mode)
+        if name is None: name = self.name
+        h1 = ROOT.TH1D(name, self.title, self.nbins, array('d', self.binEdges()))
+        h1.SetDirectory(0)
+        h1.GetXaxis().SetTitle(self.xlabel)
+        h1.GetYaxis().SetTitle(self.ylabel)
+        for i in range(self.nbins):
+            h1.SetBinContent(i+1, val[i])
+            h1.SetBinError(i+1, err[i])
+        return h1
+
+def ReadAidaFile(filename):
+    # Yields (path, name, title, xlabel, ylabel, x, val, err2) for every
+    # dataPointSet of an AIDA file. x holds (value, errorPlus, errorMinus) of
+    # the x measurement of every bin and err2 the square of the mean of the
+    # y errorPlus and errorMinus. Parsed elements are cleared right away.
+    context = iter(ET.iterparse(filename, events=("start", "end")))
+    event, root = next(context)
+    for event, elem in context:
+        if event != "end" or elem.tag != "dataPointSet": continue
+        labels = {}
+        for dim in elem.findall("dimension"):
+            labels[dim.get("dim")] = dim.get("title") or ""
+        points = elem.findall("dataPoint")
+        x = np.zeros((len(points), 3))
+        y = np.zeros((len(points), 3))
+        for i, point in enumerate(points):
+            measurements = point.findall("measurement")
+            for row, m in ((x, measurements[0]), (y, measurements[-1])):
+                row[i] = (float(m.get("value")), float(m.get("errorPlus")), float(m.get("errorMinus")))
+        with np.errstate(over='ignore'):
+            err2 = ((y[:,1]+y[:,2])/2.0)**2
+        yield (elem.get("path"), elem.get("name"), elem.get("title") or "",
+               labels.get("0", ""), labels.get("1", ""), x, y[:,0], err2)
+        root.clear()
+
+def MergeAida(filenames, histos = None):
+    # Fold the AIDA files into histos (fullPath -> AidaHisto), one file at a time
+    if histos is None: histos = {}
+    for filename in filenames:
+        for path, name, title, xlabel, ylabel, x, val, err2 in ReadAidaFile(filename):
+            fullPath = path+"/"+name
+            if fullPath not in histos:
+                histos[fullPath] = AidaHisto(path, name, title, xlabel, ylabel, x)
+            histos[fullPath].fill(val, err2)
+    return histos
+
+def AddMerged(histos, other):
+    # Add the partial merge other into histos. Paths seen first in histos keep
+    # their bin layout and titles, so adding partials in file order gives the
+    # same output as merging all files in one go.
+    for fullPath, histo in other.items():
+        if fullPath in histos: histos[fullPath].add(histo)
+        else: histos[fullPath] = histo
+    return histos
+
+def MergeAidaParallel(filenames, jobs = None, chunk_size = None):
+    # Merge the files in groups of chunk_size on a pool of jobs processes
+    # (default is one per core, with about four groups per process) and add
+    # the partial merges together in the parent, in file order.
+    if jobs is None: jobs = cpu_count()
+    filenames = list(filenames)
+    if chunk_size is None: chunk_size = max(8, -(-len(filenames)//(4*jobs)))
+    chunks = [filenames[i:i+chunk_size] for i in range(0, len(filenames), chunk_size)]
+    histos = {}
+    for chunk, partial in RunParallel(MergeAida, chunks, jobs, len(chunks) > 1, ordered=True):
+        AddMerged(histos, partial)
+    return histos
+
+def WriteAida(outfile, histos, mode = 'avg'):
+    # Write the merged histograms, sorted by path, in one AIDA file
+    with open(outfile, "w") as out:
+        out.write(AIDA_HEADER)
+        for fullPath in sorted(histos):
+            out.write(histos[fullPath].asAIDA(mode))
+        out.write(AIDA_FOOTER)
+
+def AidaToTH1s(histos, mode = 'avg'):
+    # {name: TH1D} of all merged histograms, for CompileDataset in
+    # CompileRootFiles.py. A name used by several paths goes to the first path.
+    th1s = {}
+    for fullPath in sorted(histos):
+        if histos[fullPath].name not in th1s:
+            th1s[histos[fullPath].name] = histos[fullPath].asTH1(mode)
+    return th1s
+
+def MergeAidaModes(filenames, outputs, jobs = 1):
+    # Merge the files once and write the result in every (outfile, mode) of
+    # outputs, e.g. [("merged_avg.aida", 'avg'), ("merged_add.aida", 'sum')].
+    # Returns the merged histograms.
+    for outfile, mode in outputs:
+        if mode not in MODES: raise ValueError("Unknown merge mode {0}, choose from {1}".format(mode, ", ".join(MODES)))
+    histos = MergeAidaParallel(filenames, jobs)
+    for outfile, mode in outputs:
+        WriteAida(outfile, histos, mode)
+    return histos
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog aidafile [aidafile2 ...]")
+    parser.add_option("-o", "--outfile", dest="OUTFILE",
+                      default="merged.aida", help="file for merged aida output.")
+    parser.add_option("-s", "--sum",
+                      action="store_true", dest="performSum", default=False,
+                      help="sum the bin values instead of averaging")
+    parser.add_option("-c", "--sum-channels",
+                      action="store_true", dest="sumChannels", default=False,
+                      help="sum the bin values instead of averaging but average errors")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(),
+                      help="number of processes the input files are merged on (default is the number of cores)")
+    opts, args = parser.parse_args()
+
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one AIDA histogram file\n")
+        sys.exit(1)
+
+    if opts.performSum: mode = 'sum'
+    elif opts.sumChannels: mode = 'channels'
+    else: mode = 'avg'
+
+    try:
+        WriteAida(opts.OUTFILE, MergeAidaParallel(args, opts.jobs), mode)
+    except IOError as e:
+        sys.stderr.write("Couldn't merge into %s: %s\n" % (opts.OUTFILE, e))
+        sys.exit(1)
@@ -0,0 +1,31 @@
+import glob, sys
+from optparse import OptionParser
+from multiprocessing import cpu_count
+import LHE_Functions
+from LHE_Functions import RunParallel, BuildLHECache, EvictLHECache
+
+help_text = """python cacheLHE.py [-d cache_dir] [-b budget_GB] [-j jobs] [file.lhe file.lhe.gz ...] (default is all *.lhe files)"""
+parser = OptionParser(usage=help_text)
+parser.add_option("-d", "--dir", dest="cacheDir", default=LHE_Functions.CACHE_DIR, help="Cache directory (default is $LHE_CACHE_DIR or ~/.lhe_cache).")
+parser.add_option("-b", "--budget", type="float", dest="budget", default=LHE_Functions.CACHE_BUDGET/1e9, help="Disk budget of the cache in GB, least recently used entries beyond it are removed (default is $LHE_CACHE_BUDGET bytes or 20 GB).")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files parsed in parallel (default is the number of cores).")
+(options, args) = parser.parse_args()
+
+# Parses every file once into the columnar cache. calc_XS.py, lhe2root.py and
+# everything else reading through AccumulateWeights/ReadEventBatches then use
+# the cached columns instead of the text, until the LHE file changes.
+filenames = args if args else glob.glob("*.lhe")
+if not filenames:
+    print help_text
+    sys.exit(1)
+
+def cacheFile(fname):
+    return BuildLHECache(fname, options.cacheDir).nevents
+
+if __name__ == '__main__':
+    total = 0
+    for fname, nevents in RunParallel(cacheFile, filenames, options.jobs):
+        total += nevents
+        print "{0}: {1} events cached".format(fname,nevents)
+    removed = EvictLHECache(int(options.budget*1e9), options.cacheDir)
+    print "Cached {0} events from {1} files in {2}, removed {3} old entries.".format(total,len(filenames),options.cacheDir,removed)
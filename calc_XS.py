@@ -1,64 +1,76 @@
-import glob, os, math
-import numpy as np
+import glob, os
+from optparse import OptionParser
+from multiprocessing import cpu_count
+from LHE_Functions import XSAccumulator, AccumulateWeights, RunParallel, EventByteRanges, OpenLHECache
+from LHE_Functions import SaveXSRecord, LoadXSRecord, CheckpointName, RemoveCheckpoints
 
-filenames = glob.glob("*.lhe")
+parser = OptionParser(usage="%prog [options] [file.lhe ...] (default is all *.lhe files)")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of worker processes (default is the number of cores).")
+parser.add_option("-b", "--batch", type="int", dest="batch", default=100000, help="Number of events summed per numpy batch.")
+parser.add_option("-r", "--ranges", type="int", dest="ranges", default=None, help="Number of byte ranges each file is cut into for the workers (default is one per 256 MB).")
+parser.add_option("-f", "--force", action="store_true", dest="force", default=False, help="Re-read every file, even those with an up to date <file>.xs.npz record or a checkpoint.")
+parser.add_option("-c", "--checkpoint", type="int", dest="checkpoint", default=256, help="Save the partial sums every this many MB of input (<file>.xs.ckpt), so an interrupted run picks up where it stopped. 0 turns checkpoints off (default is 256).")
+(options, args) = parser.parse_args()
+
+filenames = args if args else glob.glob("*.lhe")
 file_root_names = [os.path.splitext(name)[0] for name in filenames]
 
-def getTheWeights(eventBlock,num_shifts):
-    numParticles = int(eventBlock[1][0])
-    currWeight = float(eventBlock[1][2])
-    weight = []
-    weight.append(currWeight)
-    for i in range(numParticles+4,numParticles+4+num_shifts-1):
-        weight.append(float(eventBlock[i][2]))
-    
-    return weight
-	
 shifts = ["Nominal", "MuRFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRFup",
           "NNPDF23_as_118", "CT10as", "MSTW2008nlo68cl", "MSTW2008nlo90cl", "CT10_117", "CT10_119"]
 shifts = ["Nominal"]
 num_shifts = len(shifts)
 
-numEvents = 0
-acc_weight = np.zeros((num_shifts,), dtype=np.float64)
-acc_weight_sqr = np.zeros((num_shifts,), dtype=np.float64)
-xsecval = np.zeros((num_shifts,), dtype=np.float64)
-xsecerr = np.zeros((num_shifts,), dtype=np.float64)
-xsecerr2 = np.zeros((num_shifts,), dtype=np.float64)
+def rangeWeights(task):
+    # Partial sums over one byte range of a file, only the event info and
+    # "#new" weight lines are read.
+    fname, start, stop = task
+    checkpoint = CheckpointName(fname, 'xs', start) if options.checkpoint > 0 else None
+    return AccumulateWeights(fname, num_shifts, options.batch, start, stop, checkpoint, options.checkpoint << 20)
 
-for name_index,fname in enumerate(filenames):
-    with open(fname) as infile:
-        eventBlock = []
-        getWeights = False
-        for index,line in enumerate(infile):
-            changeWeights = False
-            if "<event>" in line: 
-                numEvents += 1
-                if (numEvents % 25000 == 0): print "Processed {0} events!".format(numEvents)
-                getWeights = True
-                changeWeights = False
-                eventBlock = []
-            if "</event>" in line: 
-                getWeights = False
-                changeWeights = True
-            if getWeights:
-                eventBlock.append(line.split())
-            if changeWeights: 
-                weights = getTheWeights(eventBlock,num_shifts)
-                
-                # weights = ["Nominal", "MuRFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRFup",
-                #           "NNPDF23_as_118", "CT10as", "MSTW2008nlo68cl", "MSTW2008nlo90cl"]
-                for i in range(num_shifts):
-                    acc_weight[i] += np.float64(weights[i])
-                    acc_weight_sqr[i] += np.float64(weights[i])*np.float64(weights[i])
-                
-                    xsecval[i] = acc_weight[i]/np.float64(numEvents)
-                    xsecerr2[i] = (acc_weight_sqr[i]/np.float64(numEvents) - xsecval[i]*xsecval[i])/np.float64(numEvents)
-                    if xsecerr2[i] < 0: 
-                        print "{0} XS error2 was < 0.0, forcing it to 0.0.".format(shifts[i])
-                        xsecerr2[i] = 0.0
-                    xsecerr[i] = math.sqrt(xsecerr2[i])
+if __name__ == '__main__':
+    # Large files are cut into byte ranges on event boundaries, so a single
+    # huge file is also spread over all workers. Each range gives its own N,
+    # sum(w) and sum(w^2) per shift. These partial results are simply added
+    # together and the cross-section is computed once. Files with a warm
+    # cache entry (cacheLHE.py) are summed from the cached weights instead.
+    #
+    # The sums of each file are stored next to it (<file>.xs.npz, with the
+    # size and mtime they belong to), so only new or changed files are read
+    # on the next run. The sums are exact, so the result is the same whichever
+    # records existed and however the files were split into ranges.
+    #
+    # While a file is read, each range checkpoints its partial sums. A rerun
+    # after a crash skips the finished ranges and carries on with the others
+    # from their last checkpoint, giving the same result as an unbroken run.
+    perFile = {}
+    stats = {}
+    tasks = []
+    for fname in filenames:
+        acc = None if options.force else LoadXSRecord(fname, num_shifts)
+        if acc is not None:
+            perFile[fname] = acc
+            continue
+        stats[fname] = os.stat(fname)
+        if options.force: RemoveCheckpoints(fname, 'xs')
+        ranges = [(None, None)] if OpenLHECache(fname) else EventByteRanges(fname, options.ranges)
+        tasks.extend([(fname, start, stop) for start, stop in ranges])
+    print "{0} of {1} files have up to date records, reading {2}.".format(len(perFile),len(filenames),len(stats))
+    for fname in stats:
+        perFile[fname] = XSAccumulator(num_shifts)
+    for (fname, start, stop), acc in RunParallel(rangeWeights, tasks, options.jobs):
+        perFile[fname].add(acc)
+    for fname in stats:
+        try:
+            SaveXSRecord(fname, perFile[fname], stats[fname])
+        except (IOError, OSError):
+            pass	# e.g. read-only input directory
+        else:
+            RemoveCheckpoints(fname, 'xs')
+    total = XSAccumulator(num_shifts)
+    for fname in filenames:
+        total.add(perFile[fname])
+        print "Processed {0} events from {1}".format(perFile[fname].nevents, fname)
 
-for i in range(num_shifts):
-    print "Estimated {0} cross-section = {1} +- {2} pb. Calculated from {3} events.".format(shifts[i],xsecval[i],xsecerr[i],numEvents)
-                
+    xsecval, xsecerr = total.result()
+    for i in range(num_shifts):
+        print "Estimated {0} cross-section = {1} +- {2} pb. Calculated from {3} events.".format(shifts[i],xsecval[i],xsecerr[i],total.nevents)
@@ -2,10 +2,19 @@
 
 import glob, os
 from optparse import OptionParser
+from multiprocessing import cpu_count
+import numpy as np
+from LHE_Functions import RunParallel, LHEReader, LHEInit, SetCrossSection, LHEBaseName, OpenLHEAt
+from LHE_Functions import EventWeights, WeightMatrixWriter, WeightMatrixName
+from LHE_Functions import CheckpointName, SaveCheckpoint, LoadCheckpoint, RemoveCheckpoints, CheckpointOutput
 
-parser = OptionParser()
+parser = OptionParser(usage="%prog [options] [file.lhe file.lhe.gz file.tar.gz ...] (default is all *.lhe files)")
 parser.add_option("-x", "--xsecup", dest="xSection", default="-1.00", help="Manually set the cross-section (pb) in LHE files (default is -1.0). This adjusts the original file and is only needed if the LHE file has -1.0 where the cross-section should be.")
 parser.add_option("-e", "--xerrup", dest="xsErr", default="-1.00", help="Manually set the cross-section error (pb) in LHE files (default is -1.0). This adjusts the original file and is only needed if the LHE file has -1.0 where the cross-section error should be.")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files processed in parallel (default is the number of cores).")
+parser.add_option("-z", "--gzip", action="store_true", dest="compress", default=False, help="Write the reweighted files gzipped (.lhe.gz).")
+parser.add_option("-m", "--matrix", action="store_true", dest="matrix", default=False, help="Instead of one reweighted copy per variation folder, write a single <file>.weights.npy weight matrix (events x variations, float64) next to each input file.")
+parser.add_option("-c", "--checkpoint", type="int", dest="checkpoint", default=256, help="Save a checkpoint (<file>.cew.ckpt) every this many MB of input, so an interrupted run carries on where it stopped when started again with the same options, -c included. With -z or gzipped input the compressed files also depend on -c, they are only identical between runs with the same -c. 0 turns checkpoints off (default is 256).")
 (options, args) = parser.parse_args()
 
 xSec = '%.5E' % float(options.xSection) # Convert it to string and in scientific notation
@@ -15,22 +24,44 @@ else: setXS = False
 print "Set Cross-section: {0}. Current value: {1}".format(setXS, options.xSection)
 
 #filenames = ["powheg.events"]
-filenames = glob.glob("*.lhe")
-file_root_names = [os.path.splitext(name)[0] for name in filenames]
+filenames = args if args else glob.glob("*.lhe")
+file_root_names = [LHEBaseName(name) for name in filenames]
 
-def getTheWeights(eventBlock,num_shifts):
-    numParticles = int(eventBlock[1][0])
-    currWeight = eventBlock[1][2]
+def getTheWeights(event,num_shifts):
+    # Only the event info line and the "#new weight" lines are split.
+    eventBlock = event.lines
+    numParticles = event.nparticles
+    currWeight = event.info[2]
     renfact = []
     facfact = []
     weight = []
     for i in range(numParticles+4,numParticles+4+num_shifts):
-        sci_not = '%.5E' % float(eventBlock[i][2])
+        newLine = eventBlock[i].split()
+        sci_not = '%.5E' % float(newLine[2])
         weight.append(sci_not)
-        renfact.append(eventBlock[i][3])
-        facfact.append(eventBlock[i][4])
+        renfact.append(newLine[3])
+        facfact.append(newLine[4])
     
     return renfact, facfact, weight, currWeight
+
+def writeEvent(event,out_files,num_shifts):
+    # Write one event into every variation file, swapping the event weight
+    # for the shifted one and dropping the "#new" reweighting lines.
+    renfact, facfact, weight, currWeight = getTheWeights(event,num_shifts)
+    newBlock = [line for line in event.lines if "#new" not in line]
+    infoLine = event.lines[1]
+    for j,out_file in enumerate(out_files):
+        newBlock[1] = infoLine.replace(currWeight,weight[j])
+        out_file.writelines(newBlock)
+
+def setCrossSection(init):
+    # Fill in XSECUP/XERRUP where the <init> block still has -1
+    initBlock = LHEInit(init)
+    SetCrossSection(float(xSec),float(xErr),only_unset=True).init(initBlock)
+    return initBlock.text()
+
+def dropNewLines(block):
+    return "".join([line for line in block.splitlines(True) if "#new" not in line])
     
 dir_names = ["MuRdownMuFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRupMuFup",
              "NNPDF23_as_118", "CT10as_113", "MSTW2008nlo68cl", "MSTW2008nlo90cl",
@@ -40,253 +71,120 @@ dir_names = ["MuRdownMuFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRupMuF
              "MSTW2008nlo68cl", "MSTW2008nlo90cl", "CT10_117", "CT10_119"]
 num_shifts = len(dir_names)
              
-for dir_name in dir_names:
-    if not os.path.exists("./"+dir_name):
-        os.mkdir("./"+dir_name)
+matrix_names = ["Nominal"] + dir_names
+MATRIX_BATCH = 100000
 
-for name_index,fname in enumerate(filenames):
-    print "Working on file: {0}. File {1} of {2}.".format(fname,name_index+1,len(filenames))
-    numEvents = 0
-    eventLine = 0
-    with open(fname) as infile:
-        eventBlock = []
-        allNewWeights = []
-        allCurrWeights = []
-        allRenFacts = []
-        allFacFacts = []
-        getWeights = False
-        if setXS:
-            with open("./"+fname+".1", "w") as new_infile:
-                initLine = 0
-                for index,line in enumerate(infile):
-                    changeWeights = False
-                    if setXS:
-                        newline = line
-                        if "<init>" in line: 
-                            initLine = index
-                        if index == initLine+2:
-                            newline = line.replace("-1.00000E+00",xSec,1)
-                            newline = newline.replace("-1.00000E+00",xErr,1)
-                        new_infile.write(newline)
-                    if "<event>" in line: 
-                        numEvents += 1
-                        getWeights = True
-                        changeWeights = False
-                        eventLine = index
-                        eventBlock = []
-                    if "</event>" in line: 
-                        getWeights = False
-                        changeWeights = True
-                    if getWeights:
-                        eventBlock.append(line.split())
-                    if changeWeights: 
-                        renfact, facfact, weight, currWeight = getTheWeights(eventBlock,num_shifts)
-                        allNewWeights.append(weight)
-                        allCurrWeights.append(currWeight)
-                        allRenFacts.append(renfact)
-                        allFacFacts.append(facfact)
-        else:
-            for index,line in enumerate(infile):
-                changeWeights = False
-                if "<event>" in line: 
-                    numEvents += 1
-                    getWeights = True
-                    changeWeights = False
-                    eventLine = index
-                    eventBlock = []
-                if "</event>" in line: 
-                    getWeights = False
-                    changeWeights = True
-                if getWeights:
-                    eventBlock.append(line.split())
-                if changeWeights: 
-                    renfact, facfact, weight, currWeight = getTheWeights(eventBlock,num_shifts)
-                    allNewWeights.append(weight)
-                    allCurrWeights.append(currWeight)
-                    allRenFacts.append(renfact)
-                    allFacFacts.append(facfact)
-    if setXS: os.rename(fname+".1",fname)
-    
-    for j,folder in enumerate(dir_names):
-        print "Copying to folder: {0}".format(folder)
-        infile = open(fname)
-        with open("./"+folder+"/"+file_root_names[name_index]+".lhe", "w") as out_file:
-            numEvents = 0
-            for index,line in enumerate(infile):
-                if "<event>" in line:
-                    numEvents += 1
-                    eventLine = index
-                if "#new" not in line:
-                    newline = line
-                    if index == eventLine+1:
-                        newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][j])
-                    out_file.write(newline)
-        infile.close()
-                
-    # infile = open(fname)    
-    # with open("./MuRdownMuFdown/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFdown:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][0])
-    #             out_MuRMuFdown.write(newline)
-    # infile.close()
-    #         
-    # infile = open(fname)
-    # with open("./MuFdown/"+file_root_names[name_index]+".lhe", "w") as out_MuFdown:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line: 
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][1])
-    #             out_MuFdown.write(newline)
-    # infile.close()
-    #         
-    # infile = open(fname)
-    # with open("./MuRdown/"+file_root_names[name_index]+".lhe", "w") as out_MuRdown:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][2])
-    #             out_MuRdown.write(newline)
-    # infile.close()
-    #     
-    # infile = open(fname)    
-    # with open("./MuFup/"+file_root_names[name_index]+".lhe", "w") as out_MuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][3])
-    #             out_MuFup.write(newline)
-    # infile.close()
-    #  
-    # infile = open(fname)       
-    # with open("./MuRup/"+file_root_names[name_index]+".lhe", "w") as out_MuRup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][4])
-    #             out_MuRup.write(newline)
-    # infile.close()
-    # 
-    # infile = open(fname)        
-    # with open("./MuRupMuFup/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][5])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open("./NNPDF23_as_118/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][6])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open("./CT10as_113/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][7])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open("./MSTW2008nlo68cl/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][8])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open("./MSTW2008nlo90cl/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][9])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open(".//"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][7])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
-    #
-    # infile = open(fname)
-    # with open("./CT10_119/"+file_root_names[name_index]+".lhe", "w") as out_MuRMuFup:
-    #     numEvents = 0
-    #     for index,line in enumerate(infile):
-    #         if "<event>" in line:
-    #             numEvents += 1
-    #             eventLine = index
-    #         if "#new" not in line:
-    #             newline = line
-    #             if index == eventLine+1:
-    #                 newline = line.replace(allCurrWeights[numEvents-1],allNewWeights[numEvents-1][7])
-    #             out_MuRMuFup.write(newline)
-    # infile.close()
\ No newline at end of file
+if not options.matrix:
+    for dir_name in dir_names:
+        if not os.path.exists("./"+dir_name):
+            os.mkdir("./"+dir_name)
+
+# Each file is read once. Events are handed over one at a time and written
+# into all of the variation files together, so memory use does not grow with
+# the number of events or variations. Files are spread over a process pool.
+# In matrix mode the event weight and the #new weights of each event become one
+# row of the weight matrix (columns "Nominal" followed by dir_names) and no
+# copies are written at all.
+#
+# Every options.checkpoint MB of input the outputs are synced to disk and the
+# input offset, the number of events and the size of every output go into
+# <file>.cew.ckpt. Started again after a crash, the outputs are cut back to
+# those sizes and the input is read on from that offset, which gives the same
+# files as a run that never stopped with the same -c. Gzipped outputs get a
+# new gzip member at every checkpoint, so their bytes depend on -c, and a
+# checkpoint is only resumed with the -c it was written with.
+def processFile(name_index):
+    fname = filenames[name_index]
+    interval = options.checkpoint << 20
+    checkpoint = CheckpointName(fname, 'cew')
+    settings = [options.matrix, options.compress, xSec, xErr, options.checkpoint]
+    # The original file is rewritten with the new cross-section, in the same
+    # compression as it came in. A member of a tarball cannot be rewritten in
+    # place, the new cross-section then only goes into the variation files.
+    fixInput = setXS and not fname.endswith((".tar.gz",".tgz"))
+    if setXS and not fixInput: print "Cannot rewrite {0} in place, only the output files get the new cross-section.".format(fname)
+    tmp_name = fname[:-3]+".1.gz" if fname.endswith(".gz") else fname+".1"
+    out_names = [] if options.matrix else ["./"+folder+"/"+file_root_names[name_index]+".lhe" for folder in dir_names]
+    if options.compress: out_names = [name+".gz" for name in out_names]
+
+    # Outputs in checkpoint order: variation files, rewritten input, weight matrix
+    state = LoadCheckpoint(checkpoint, fname) if interval > 0 else None
+    if state is not None:
+        names = out_names + [tmp_name]*fixInput + [WeightMatrixName(fname)+".tmp"]*options.matrix
+        sizes = state['outputs']
+        if state['settings'] != settings or len(sizes) != len(names) or \
+           not all(os.path.isfile(name) and os.path.getsize(name) >= size for name, size in zip(names, sizes)):
+            state = None
+    if state is None:
+        sizes = [None]*(len(out_names)+fixInput+options.matrix)
+        reader = LHEReader(fname)
+    else:
+        print "Resuming {0} after {1} events.".format(fname,state['nevents'])
+        reader = OpenLHEAt(fname, state['offset'])
+        reader.nevents = state['nevents']
+
+    out_files = [CheckpointOutput(name, options.compress, size) for name, size in zip(out_names, sizes)]
+    if fixInput:
+        new_infile = CheckpointOutput(tmp_name, fname.endswith(".gz"), sizes[len(out_names)])
+    if options.matrix:
+        matrix = WeightMatrixWriter(WeightMatrixName(fname), matrix_names, sizes[-1])
+        tokens = []
+
+    def saveCheckpoint(offset):
+        outputs = [out_file.sync() for out_file in out_files]
+        if fixInput: outputs.append(new_infile.sync())
+        if options.matrix:
+            if tokens: matrix.fill(np.array(tokens).astype(np.float64).reshape(-1,num_shifts+1))
+            del tokens[:]
+            outputs.append(matrix.sync())
+        SaveCheckpoint(checkpoint, fname, {'settings': settings, 'offset': offset,
+                                           'nevents': reader.nevents, 'outputs': outputs})
+
+    with reader:
+        if state is None:
+            init = reader.init
+            if setXS:
+                init = setCrossSection(init)
+            if fixInput:
+                new_infile.write(reader.header+init)
+            for out_file in out_files:
+                out_file.write(dropNewLines(reader.header+init))
+        last = None
+        for event in reader.events():
+            if fixInput: new_infile.write(event.text)
+            if options.matrix:
+                tokens.extend(EventWeights(event,num_shifts+1))
+                if len(tokens) >= MATRIX_BATCH*(num_shifts+1):
+                    matrix.fill(np.array(tokens).astype(np.float64).reshape(-1,num_shifts+1))
+                    del tokens[:]
+            else:
+                writeEvent(event,out_files,num_shifts)
+            end = event.offset+len(event.text)
+            if last is None: last = event.offset
+            if interval > 0 and end-last >= interval:
+                saveCheckpoint(end)
+                last = end
+        for out_file in out_files:
+            out_file.write(dropNewLines(reader.footer))
+            out_file.close()
+        numEvents = reader.nevents
+    if options.matrix:
+        if tokens: matrix.fill(np.array(tokens).astype(np.float64).reshape(-1,num_shifts+1))
+        matrix.close()
+    if fixInput:
+        new_infile.write(reader.footer)
+        new_infile.close()
+        os.rename(tmp_name,fname)
+    RemoveCheckpoints(fname, 'cew')
+    if options.matrix: return numEvents, [matrix.filename]
+    return numEvents, [out_file.name for out_file in out_files]
+
+if __name__ == '__main__':
+    totalEvents = 0
+    totalFiles = 0
+    for name_index, (numEvents, written) in RunParallel(processFile, range(len(filenames)), options.jobs):
+        if options.matrix: print "{0}: wrote {1} x {2} weights to {3}.".format(filenames[name_index],numEvents,len(matrix_names),written[0])
+        else: print "{0}: wrote {1} events to {2} folders.".format(filenames[name_index],numEvents,num_shifts)
+        totalEvents += numEvents
+        totalFiles += len(written)
+    print "Wrote {0} events from {1} input files into {2} output files.".format(totalEvents,len(filenames),totalFiles)
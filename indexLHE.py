@@ -0,0 +1,29 @@
+import glob, sys
+from optparse import OptionParser
+from LHE_Functions import LoadLHEIndex, BuildLHEIndex, INDEX_SUFFIX
+
+help_text = """python indexLHE.py [-f] [file.lhe ...] (default is all *.lhe files)"""
+parser = OptionParser(usage=help_text)
+parser.add_option("-f", "--force", action="store_true", dest="force", default=False, help="Rebuild the index even if the existing one is up to date.")
+(options, args) = parser.parse_args()
+
+# Writes a <file>.lhe.idx sidecar holding the byte offsets of every event so
+# that Count_Events_LHEF.py, splitLHE.py, mergeLHE.py and removeIncEvents.py
+# can seek straight to the events. Stale indices are rebuilt automatically.
+filenames = args if args else glob.glob("*.lhe")
+if not filenames:
+    print help_text
+    sys.exit(1)
+
+total = 0
+for fname in filenames:
+    if options.force:
+        index = BuildLHEIndex(fname)
+        index.save()
+    else:
+        index = LoadLHEIndex(fname)
+    total += index.nevents
+    status = " (truncated last event)" if index.truncated else ""
+    print "{0}: {1} events{2} -> {3}".format(fname,index.nevents,status,fname+INDEX_SUFFIX)
+
+print "Total number of events in given files: %i" % total
@@ -0,0 +1,59 @@
+import os, sys, stat, errno
+from optparse import OptionParser
+from LHE_Functions import LHEReader, LHEInit, HepMCWriter, SelectWeight, WeightMatrixName, LoadWeightMatrix, CountEvents
+
+help_text = """python lhe2hepmc.py [-w MuFup] [--fifo] file.lhe [file.lhe.gz ...] output.hepmc"""
+parser = OptionParser(usage=help_text)
+parser.add_option("-w", "--weight", dest="weight", default="Nominal", help="Weight variation written as the event weight: Nominal, one of the changeEventWeight.py folder names (MuFup, CT10_117, ...) or the number of the #new weight line (default is Nominal).")
+parser.add_option("--fifo", action="store_true", dest="fifo", default=False, help="Create the output as a named pipe (if it does not exist yet) and stream into it, e.g. for 'rivet hepmc.fifo'.")
+(options, args) = parser.parse_args()
+
+# Same order as the "#new" weight lines, see dir_names in changeEventWeight.py
+weight_names = ["Nominal", "MuRdownMuFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRupMuFup",
+                "MSTW2008nlo68cl", "MSTW2008nlo90cl", "CT10_117", "CT10_119"]
+
+if len(args) < 2:
+    print help_text
+    sys.exit(1)
+filenames = args[:-1]
+output_name = args[-1]
+
+if options.weight.isdigit(): weight_index = int(options.weight)
+elif options.weight in weight_names: weight_index = weight_names.index(options.weight)
+else:
+    print "Unknown weight variation {0}, choose from {1} or a #new line number.".format(options.weight,", ".join(weight_names))
+    sys.exit(1)
+
+if options.fifo and not os.path.exists(output_name):
+    os.mkfifo(output_name)
+if os.path.exists(output_name) and stat.S_ISFIFO(os.stat(output_name).st_mode):
+    print "Waiting for a reader on {0}".format(output_name)
+
+# Events are converted one at a time and written straight into the output,
+# so with a fifo no HepMC file ever lands on disk. All input files go into
+# one event stream. If a changeEventWeight.py -m weight matrix sits next to an
+# input file, the chosen variation is read from it instead of the event text,
+# as long as it has one row per event of the file. A matrix left over from an
+# older version of the file is ignored.
+try:
+    with open(output_name, "wb") as out:
+        writer = None
+        for fname in filenames:
+            weights = None
+            if os.path.isfile(WeightMatrixName(fname)) and options.weight in weight_names:
+                weights = LoadWeightMatrix(fname)[options.weight]
+                if len(weights) != CountEvents(fname):
+                    print "{0} does not match {1}, using the event weights.".format(WeightMatrixName(fname),fname)
+                    weights = None
+            with LHEReader(fname) as reader:
+                if writer is None:
+                    writer = HepMCWriter(out, LHEInit(reader.init), options.weight)
+                for i, event in enumerate(reader.events()):
+                    if weights is not None: writer.write(event, float(weights[i]))
+                    else: writer.write(event, SelectWeight(event, weight_index))
+            print "{0}: {1} events".format(fname,reader.nevents)
+        if writer is not None: writer.close()
+except IOError as e:
+    # The reader went away (e.g. rivet -n), nothing more to do
+    if e.errno != errno.EPIPE: raise
+    print "Reader closed {0}, stopping.".format(output_name)
@@ -4,37 +4,47 @@
 # James.Henderson@cern.ch
 #
 # Usage:
-# lhe2root.py <input_file.lhe> <OPTIONAL: output_file_name.root>
+# lhe2root.py [-c <compression level>] [-b <basket size>] [-n <events per batch>] [-j <parsing processes>] <input_file.lhe> <OPTIONAL: output_file_name.root>
 #
 # PLEASE NOTE: This conversion was generated to convert les houches 1.0, it may not work on other versions
 #              Please check the les houches version # at the top of the .lhe file
 
 import os, sys
+from optparse import OptionParser
+from multiprocessing import cpu_count
 import ROOT as r
 from ROOT import TTree, TFile, AddressOf, gROOT
+from LHE_Functions import LHEReader, EventBatch, ReadEventBatches, EventByteRanges, RunParallel, OpenLHECache, IsCompressed
+
+parser = OptionParser(usage="%prog [options] <input_file.lhe> <OPTIONAL: output_file_name.root>")
+parser.add_option("-c", "--compression", type="int", dest="compression", default=1, help="ROOT compression level of the output file (default is 1).")
+parser.add_option("-b", "--basket-size", type="int", dest="basketSize", default=256000, help="Basket size in bytes for every branch of the Physics tree (default is 256000).")
+parser.add_option("-n", "--batch", type="int", dest="batch", default=50000, help="Number of events parsed into numpy arrays and written to the tree at a time (default is 50000).")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of processes parsing byte ranges of the input file (default is the number of cores).")
+(options, args) = parser.parse_args()
 
 # Get the input lhe file
-if len(sys.argv) < 2:
+if len(args) < 1:
     print "\nYou must enter the .lhe file you wish to convert as the first arguement. Exiting \n"
     sys.exit(1)
 
-try:    input_file = file( sys.argv[1], 'r')
+try:    LHEReader( args[0] ).close()
 except:
     print "\nThe entered file cannot be opened, please enter a vaild .lhe file. Exiting. \n"
     sys.exit(1)
     pass
 
-if len(sys.argv) > 2:    output_file_name = sys.argv[2]
-else:                    output_file_name = "lhe.root"
+if len(args) > 1:    output_file_name = args[1]
+else:                output_file_name = "lhe.root"
 
-try:    output_file = TFile(output_file_name, "RECREATE")
+try:    output_file = TFile(output_file_name, "RECREATE", "", options.compression)
 except:
     print "Cannot open output file named: " + output_file_name + "\nPlease enter a valid output file name as the 2nd arguement. Exiting"
     sys.exit(1)
     pass
 
 output_tree = TTree("Physics", "Physics")
-print "Setup complete \nOpened file " + str(sys.argv[1]) + "  \nConverting to .root format and outputing to " + output_file_name
+print "Setup complete \nOpened file " + str(args[0]) + "  \nConverting to .root format and outputing to " + output_file_name
 
 # Setup output branches
 PID_v = r.vector('Int_t')()
@@ -48,6 +58,35 @@ M_v =r.vector('Double_t')()
 gROOT.ProcessLine( "struct MyStruct{ Int_t n_particles; Double_t weight; };")
 from ROOT import MyStruct
 
+# The per-event loop runs in compiled code: it is handed the numpy columns of
+# a whole batch of events and fills the branch variables and the tree from them.
+gROOT.ProcessLine( """
+void FillLHEBatch( TTree* tree, MyStruct* s, std::vector<Int_t>* pid_v,
+                   std::vector<Double_t>* px_v, std::vector<Double_t>* py_v, std::vector<Double_t>* pz_v,
+                   std::vector<Double_t>* e_v, std::vector<Double_t>* m_v,
+                   Long_t nevents, const Long_t* offsets, const Double_t* weight,
+                   const Int_t* pid, const Int_t* status, const Double_t* px, const Double_t* py,
+                   const Double_t* pz, const Double_t* e, const Double_t* m ) {
+    for ( Long_t i = 0; i < nevents; ++i ) {
+        s->n_particles = 0;
+        s->weight = weight[i];
+        pid_v->clear(); px_v->clear(); py_v->clear(); pz_v->clear(); e_v->clear(); m_v->clear();
+        for ( Long_t j = offsets[i]; j < offsets[i+1]; ++j ) {
+            // Only final state particles are kept
+            if ( status[j] != 1 ) continue;
+            s->n_particles += 1;
+            pid_v->push_back( pid[j] );
+            px_v->push_back( px[j] );
+            py_v->push_back( py[j] );
+            pz_v->push_back( pz[j] );
+            e_v->push_back( e[j] );
+            m_v->push_back( m[j] );
+        }
+        tree->Fill();
+    }
+}""" )
+from ROOT import FillLHEBatch
+
 # Assign the variables to the struct
 s = MyStruct() 
 output_tree.Branch('n_particles',AddressOf(s,'n_particles'),'n_particles/I')
@@ -58,68 +97,44 @@ output_tree.Branch("P_Y",P_Y_v)
 output_tree.Branch("P_Z",P_Z_v)
 output_tree.Branch("E",E_v)
 output_tree.Branch("M",M_v)
+output_tree.SetBasketSize("*", options.basketSize)
 
-skippedLines = []
-in_ev = 0 # To know when to look for particles we must know when we are inside an event
-in_ev_1 = 0 # The first line after <event> is information so we must skip that as well
-s.n_particles = 0
-s.weight = 0
-for line in input_file:
-    
-    if line[:1] == "#":
-        continue
-    
-    if in_ev_1 == 1:
-        in_ev_1 = 0
-        s.weight = float( line.split()[2] )
-        in_ev = 1
-        continue
-    
-    if line.strip().startswith("<event>"):
-        in_ev_1 = 1
-        continue
-    
-    # Some versions of les houches have a pdf line that we don't care about here
-    if line.startswith("#pdf"):
-        continue
-    
-    if in_ev == 1 and (line.strip().startswith("</event>") or line.strip().startswith("<rwgt>")):
-        output_tree.Fill()
-        # Reset variables
-        s.n_particles = 0
-        s.weight = 0
-        PID_v.clear()
-        P_X_v.clear()
-        P_Y_v.clear()
-        P_Z_v.clear()
-        E_v.clear()
-        M_v.clear()
-        in_ev = 0
-        continue
-    
-    if in_ev == 1:
-        # Check the status of this particle
-        try:
-            if line.split()[1] is "1":
-                # We have a final state particle on this line
-                s.n_particles += 1
-                PID_v.push_back( int(line.split()[0]) )
-                P_X_v.push_back( float(line.split()[6]) )
-                P_Y_v.push_back( float(line.split()[7]) )
-                P_Z_v.push_back( float(line.split()[8]) )
-                E_v.push_back( float(line.split()[9]) )
-                M_v.push_back( float(line.split()[10]) )
-                pass
-            pass
-        except:
-            if line not in skippedLines:
-                print "Problem with line: ", line.replace("\n","")
-                print "Skipping..."
-                skippedLines.append( line )
-                pass
-            pass
-        pass
-    pass
+# The text parsing is spread over worker processes, each one turning a byte
+# range of the input into a numpy batch. The ranges are cut to hold about
+# one batch of events each and come back in file order, only a few of them
+# ahead of the tree filling done here, so the event order is unchanged and
+# memory does not grow with the file. Compressed input and a warm cache
+# entry (cacheLHE.py) are streamed batch by batch in this process instead.
+def rangeCount(filename):
+    # Number of byte ranges of about options.batch events each, from the
+    # average event size at the start of the events
+    with open(filename, 'rb') as f: sample = f.read(1 << 24)
+    first = sample.find(b'<event>')
+    nevents = sample.count(b'<event>')
+    if nevents < 2: return options.jobs
+    event_size = float(sample.rfind(b'<event>')-first)/(nevents-1)
+    return max(options.jobs, int((os.path.getsize(filename)-first)/(event_size*options.batch))+1)
+
+def parseRange(task):
+    start, stop = task
+    with LHEReader(args[0], start=start, stop=stop) as reader:
+        events = list(reader.events())
+    return [EventBatch(events)] if events else []
+
+if OpenLHECache(args[0]) or IsCompressed(args[0]):
+    results = [((None, None), ReadEventBatches(args[0], options.batch))]
+else:
+    results = RunParallel(parseRange, EventByteRanges(args[0], rangeCount(args[0])), options.jobs,
+                          progress=False, ordered=True, max_pending=2*options.jobs)
+
+numEvents = 0
+for task, batches in results:
+    for batch in batches:
+        FillLHEBatch(output_tree, s, PID_v, P_X_v, P_Y_v, P_Z_v, E_v, M_v,
+                     batch.nevents, batch.offsets, batch.weight,
+                     batch.pid, batch.status, batch.px, batch.py, batch.pz, batch.e, batch.m)
+        numEvents += batch.nevents
+        print "Converted {0} events".format(numEvents)
 
 output_tree.Write()
 output_file.Close()
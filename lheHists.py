@@ -0,0 +1,110 @@
+import glob, sys
+from optparse import OptionParser
+from multiprocessing import cpu_count
+import ROOT
+from Aux_Functions import GetListDataset
+from LHE_Functions import RunParallel, EventByteRanges, OpenLHECache, FillPartonHistograms, XSAccumulator
+
+help_text = """python lheHists.py [-o VBF_Systematics.root] [-d pwhg_back_bornsupp] [-j jobs] [file.lhe ...] (default is all *.lhe files)"""
+parser = OptionParser(usage=help_text)
+parser.add_option("-o", "--output", dest="output", default="VBF_Systematics.root", help="ROOT file the histograms are written (or added) to (default is VBF_Systematics.root).")
+parser.add_option("-d", "--datasets", dest="datasets", default="", help="Aux_Functions.py list used to name the dataset directories, e.g. pwhg_back_bornsupp. A variation goes into the first dataset whose name contains it (MuFdown -> 000002.Powheg.W2jets.MuFdown.bornsuppfact). Without it the directories are named after the variations.")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of worker processes (default is the number of cores).")
+parser.add_option("-r", "--ranges", type="int", dest="ranges", default=None, help="Number of byte ranges each file is cut into for the workers (default is one per 256 MB).")
+parser.add_option("-b", "--batch", type="int", dest="batch", default=50000, help="Number of events histogrammed per numpy batch (default is 50000).")
+(options, args) = parser.parse_args()
+
+filenames = args if args else glob.glob("*.lhe")
+if not filenames:
+    print help_text
+    sys.exit(1)
+
+# XWGTUP followed by the "#new" weights, same order as dir_names in changeEventWeight.py
+weight_names = ["Nominal", "MuRdownMuFdown", "MuFdown", "MuRdown", "MuFup", "MuRup", "MuRupMuFup",
+                "MSTW2008nlo68cl", "MSTW2008nlo90cl", "CT10_117", "CT10_119"]
+num_weights = len(weight_names)
+
+# (histogram name, observable, nbins, low, high). The names are the ones the
+# Rivet analysis uses, so titles come from dictList and Find_Error_Band.py
+# finds them where it expects them.
+hist_defs = [("DijetMass_2jet_1", "mjj", 100, 0., 5000.),
+             ("DeltaY_2jet_1", "dyjj", 50, 0., 10.),
+             ("FirstJetPt_2jet_1", "ptj1", 100, 0., 1000.),
+             ("Ht_2jet_1", "htjj", 100, 0., 2000.),
+             ("WBosonPt_1", "ptw", 100, 0., 1000.)]
+
+def datasetDirectory(variation, datasets):
+    for dataset in datasets:
+        if variation in dataset.split('.'): return dataset
+    return variation
+
+def fillRange(task):
+    # Histograms of one byte range of a file, all variations in one pass
+    fname, start, stop = task
+    return FillPartonHistograms(fname, hist_defs, num_weights, start, stop, options.batch)
+
+def makeTH1(name, histogram, variation, nevents):
+    # d(sigma)/dx in pb per unit of x, under- and overflow are not divided by the width
+    h1 = ROOT.TH1D(name, name, histogram.nbins, histogram.edges[0], histogram.edges[-1])
+    widths = [1.0] + list(histogram.edges[1:]-histogram.edges[:-1]) + [1.0]
+    for i in range(histogram.nbins+2):
+        h1.SetBinContent(i, histogram.sumw[variation,i]/nevents/widths[i])
+        h1.SetBinError(i, histogram.sumw2[variation,i]**0.5/nevents/widths[i])
+    h1.SetEntries(nevents)
+    return h1
+
+def StyleHistogram(h1, titles):
+    h1.SetTitle(titles[0])
+    h1.GetXaxis().SetTitle(titles[1])
+    h1.GetYaxis().SetTitle(titles[2])
+    h1.SetOption("HIST E")
+
+def cdDirectory(parent, name):
+    directory = parent.GetDirectory(name)
+    if not directory: directory = parent.mkdir(name)
+    directory.cd()
+    return directory
+
+if __name__ == '__main__':
+    tasks = []
+    for fname in filenames:
+        ranges = [(None, None)] if OpenLHECache(fname) else EventByteRanges(fname, options.ranges)
+        tasks.extend([(fname, start, stop) for start, stop in ranges])
+
+    # Partial histograms and weight sums from every range are simply added together
+    histograms = None
+    total = XSAccumulator(num_weights)
+    for task, (partial, partial_total) in RunParallel(fillRange, tasks, options.jobs):
+        if histograms is None: histograms = partial
+        else:
+            for name in histograms: histograms[name].add(partial[name])
+        total.add(partial_total)
+    nevents = total.nevents
+    xsecs = total.result()[0]
+    print "Histogrammed {0} events from {1} files.".format(nevents,len(filenames))
+    if nevents == 0: sys.exit(1)
+
+    dictList = GetListDataset('dictList')
+    datasets = GetListDataset(options.datasets) if options.datasets else []
+    hf = ROOT.TFile(options.output, "UPDATE")
+    for v, variation in enumerate(weight_names):
+        folder = datasetDirectory(variation, datasets)
+        # Total cross-section of this variation, over all events
+        xsec = xsecs[v]
+        print folder, xsec
+        directory = cdDirectory(hf, folder)
+        for name, observable, nbins, low, high in hist_defs:
+            titles = dictList.get(name, (name, observable, "d#sigma/dx [pb]", "d#sigma/dx [events]"))
+            directory.cd()
+            h1 = makeTH1(name, histograms[name], v, nevents)
+            StyleHistogram(h1, titles)
+            h1.Write("", ROOT.TObject.kOverwrite)
+            # Same as CompileRootFiles.py: normalized to the cross-section in Normalized_XS
+            h1_norm = h1.Clone(name+"_norm")
+            h1_norm.GetYaxis().SetTitle("(1/#sigma) "+titles[3])
+            h1_norm.Scale(1.0/xsec)
+            cdDirectory(directory, "Normalized_XS")
+            h1_norm.Write("", ROOT.TObject.kOverwrite)
+            del h1, h1_norm
+    hf.Close()
+    print "Wrote {0} histograms for {1} weight variations to {2}".format(len(hist_defs),num_weights,options.output)
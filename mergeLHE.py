@@ -1,45 +1,63 @@
-import glob
+import glob, sys
 from optparse import OptionParser
 from datetime import datetime
+from LHE_Functions import LHEReader, LHEInit, CombineInits, LoadLHEIndex, CountEvents, CopyRange, SendRange, IsCompressed, OpenLHEOutput
 
-# TODO: add the capabality to choose between
-#           globbing all lhe files
-#           inputting specific files by hand
-#       add the capability to name output file
-
-help_text = """python mergeLHE.py -s /path/to/save/dir"""
+help_text = """python mergeLHE.py -s /path/to/save/dir [-o outfile.lhe] [-z] [file1.lhe file2.lhe.gz ...] (default is all *.lhe files)"""
 parser = OptionParser(usage=help_text)
 parser.add_option("-s", "--save_loc", type="string", dest="save_loc", default=".", help="Sets the location of the output file.")
+parser.add_option("-o", "--output", type="string", dest="output", default="outfile.lhe", help="Name of the merged file (default is outfile.lhe).")
+parser.add_option("-z", "--gzip", action="store_true", dest="compress", default=False, help="Write the merged file gzipped (.lhe.gz).")
 (options, args) = parser.parse_args()
 
 #filenames = glob.glob('*.events')
-filenames = glob.glob('*.lhe')
+filenames = args if args else glob.glob('*.lhe')
 startTime = datetime.now()
 save_location = options.save_loc
+if not filenames:
+    print help_text
+    sys.exit(1)
+
+# Check that all of the inputs are the same process and combine their
+# cross-sections, weighted by the number of events in each file.
+inits = []
+nevents = []
+for fname in filenames:
+    with LHEReader(fname) as reader:
+        inits.append(LHEInit(reader.init))
+    nevents.append(CountEvents(fname))
+try:
+    init = CombineInits(inits, nevents)
+except ValueError as e:
+    print "Cannot merge these files: {0}".format(e)
+    sys.exit(1)
+for process in init.processes:
+    print "Process {0}: XSECUP = {1:.5E} +- {2:.5E} pb".format(process[3], process[0], process[1])
 
-with open(save_location+'/outfile.lhe', 'w') as outfile:
+with OpenLHEOutput(save_location+'/'+options.output, options.compress) as outfile:
     numEvents = 0
-    outfile.write("""<LesHouchesEvents version="1.0">\n""")
-    with open(filenames[0]) as toGetHeader:
-        writeHeader = False
-        for line in toGetHeader:
-            if "<!--" in line: writeHeader = True
-            if writeHeader: outfile.write(line)
-            if "</init>" in line:
-                break
-    for fname in filenames:
-        writeLine = False
-        stopWrite = False
-        with open(fname) as infile:
-            for line in infile:
-                if "<event>" in line:
-                    numEvents += 1
-                    writeLine = True
-                if "</LesHouchesEvents>" in line:
-                    stopWrite = True
-                if writeLine and not stopWrite:
-                    outfile.write(line)
-    outfile.write("</LesHouchesEvents>")
+    for index,fname in enumerate(filenames):
+        if IsCompressed(fname):
+            # No byte offsets into a compressed file, stream its events instead
+            with LHEReader(fname) as reader:
+                if index == 0: outfile.write(reader.header+init.text())
+                for event in reader.events():
+                    outfile.write(event.text)
+                numEvents += reader.nevents
+            continue
+        lhe_index = LoadLHEIndex(fname)
+        with open(fname, 'rb') as infile:
+            if index == 0:
+                # Header is taken from the first file, followed by the combined <init> block
+                CopyRange(infile, outfile, 0, lhe_index.init_start)
+                outfile.write(init.text())
+            # All of the events of a file are one contiguous byte range, which
+            # the kernel can copy directly unless the output is compressed
+            if lhe_index.nevents > 0:
+                if options.compress: CopyRange(infile, outfile, lhe_index.starts[0], lhe_index.ends[-1])
+                else:                SendRange(infile, outfile, lhe_index.starts[0], lhe_index.ends[-1])
+        numEvents += lhe_index.nevents
+    outfile.write(b"</LesHouchesEvents>")
     
 print "There were {0} events processed in {1} files.".format(numEvents, len(filenames))
-print(datetime.now()-startTime)
\ No newline at end of file
+print(datetime.now()-startTime)
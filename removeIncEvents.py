@@ -1,19 +1,21 @@
-import sys,glob,os
+import sys,glob
+from optparse import OptionParser
+from multiprocessing import cpu_count
+from LHE_Functions import RepairLHE, RunParallel
 
-platform = sys.platform
+parser = OptionParser(usage="%prog [options] [file.lhe ...] (default is all *.lhe files)")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files repaired in parallel (default is the number of cores).")
+(options, args) = parser.parse_args()
 
-for file in glob.glob("*.lhe"):
-  line_number = 0
-  for line in reversed(open(file).readlines()):
-    if "</event>" in line:
-      break
-    else:
-      line_number += 1
-  new_file = file+".new"
-  if line_number <= 1: continue
-  if platform == "darwin":
-    cmd = "ghead -n -"+str(line_number)+" "+file+" > "+new_file+" && mv "+new_file+" "+file
-  else:
-    cmd = "head -n -"+str(line_number)+" "+file+" > "+new_file+" && mv "+new_file+" "+file
-  print cmd
-  os.system(cmd)
+# Each file is searched backwards from the end for the last complete event,
+# truncated in place right after it and closed with </LesHouchesEvents>.
+# Nothing but the tail of a file is ever read or written.
+filenames = args if args else glob.glob("*.lhe")
+if __name__ == '__main__':
+  total_dropped = 0
+  for task, (file, dropped, removed, changed) in RunParallel(RepairLHE, filenames, options.jobs):
+    if removed < 0: print "{0}: no complete event found, left untouched".format(file)
+    elif removed > 0: print "{0}: dropped {1} incomplete event(s), removed {2} bytes".format(file,dropped,removed)
+    elif changed: print "{0}: closing tag appended".format(file)
+    total_dropped += dropped
+  print "Dropped {0} incomplete events in {1} files".format(total_dropped,len(filenames))
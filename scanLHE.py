@@ -0,0 +1,33 @@
+import glob, sys, json
+from optparse import OptionParser
+from multiprocessing import cpu_count
+from LHE_Functions import RunParallel, ScanLHE
+
+help_text = """python scanLHE.py [-o lhe_scan.json] [-j jobs] [file.lhe file.lhe.gz file.tar.gz ...] (default is all *.lhe files)"""
+parser = OptionParser(usage=help_text)
+parser.add_option("-o", "--output", dest="output", default="lhe_scan.json", help="JSON report with the md5, event count and problems of every file (default is lhe_scan.json).")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files scanned in parallel (default is the number of cores).")
+(options, args) = parser.parse_args()
+
+# One read per file does what Count_Events_LHEF.py, removeIncEvents.py and
+# List_md5.py each needed a full read for: the number of complete events, a
+# cut off last event or missing </LesHouchesEvents>, an unset XSECUP in the
+# <init> block and the md5 of the file as it is on disk.
+filenames = args if args else glob.glob("*.lhe")
+if not filenames:
+    print help_text
+    sys.exit(1)
+
+if __name__ == '__main__':
+    report = []
+    totalEvents = 0
+    for fname, result in RunParallel(ScanLHE, sorted(filenames), options.jobs, ordered=True):
+        report.append(result)
+        totalEvents += result['events']
+        status = "OK" if not result['problems'] else ", ".join(result['problems'])
+        print "{0}: {1} events, md5 {2}, {3}".format(fname,result['events'],result['md5'],status)
+    bad = [result['file'] for result in report if result['problems']]
+    with open(options.output, "w") as out:
+        json.dump({'files': report, 'events': totalEvents, 'bad_files': bad}, out, indent=2, sort_keys=True)
+    print "Scanned {0} files with {1} events, {2} with problems. Report written to {3}".format(len(report),totalEvents,len(bad),options.output)
+    if bad: sys.exit(2)
@@ -1,19 +1,109 @@
 #!/usr/bin/python
 
-import sys, getopt, os
+import sys, getopt, os, array
+from multiprocessing import cpu_count
+import numpy as np
+from LHE_Functions import RunParallel, LHEReader, LHEIndex, LoadLHEIndex, CopyRange, SendRange, IsCompressed, LHEBaseName, OpenLHEOutput
 
 def printUsage():
-    print 'Usage: splitLHE.py -i <input LHE file> -n <number of events per output file>\nPlease try again'
+    print 'Usage: splitLHE.py -i <input LHE file> (-n <number of events per output file> | -k <number of output files> | -s <target size per output file, e.g. 500M>) [-j <number of parallel jobs>] [-z (gzip the output files)]\nPlease try again'
+
+def parseSize(arg):
+    # Bytes, with an optional K, M or G suffix
+    factors = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    arg = arg.strip().upper().rstrip('B')
+    if arg and arg[-1] in factors: return int(float(arg[:-1])*factors[arg[-1]])
+    return int(float(arg))
+
+def planShards(index, nEvt=None, nFiles=None, maxBytes=None):
+    # Event number where each output file starts, plus the total at the end.
+    # -n gives fixed size shards, -k exactly nFiles shards whose event counts
+    # differ by at most one, and -s as many shards as needed to stay near
+    # maxBytes, with the cuts placed at equal byte fractions of the events so
+    # all shards come out about the same size.
+    nevents = index.nevents
+    if nevents == 0: return [0]
+    if nEvt is not None:
+        cuts = range(0, nevents, nEvt)
+    elif nFiles is not None:
+        nFiles = min(nFiles, nevents)	# no empty files
+        cuts = [nevents*i//nFiles for i in range(nFiles)]
+    else:
+        first, total = index.starts[0], index.ends[-1]-index.starts[0]
+        nFiles = max(1, -(-total//maxBytes))
+        cuts = np.searchsorted(index.starts, [first + (total*i)//nFiles for i in range(nFiles)])
+        cuts = sorted(set(int(cut) for cut in cuts if cut < nevents))
+    return list(cuts) + [nevents]
+
+def writeChunk(task):
+    # Write one output file: the common block, one byte range of events and the closing tag
+    inputfile, outname, header_end, start, stop, compress = task
+    with open(inputfile,"rb") as infile, OpenLHEOutput(outname,compress) as outFile:
+        CopyRange(infile, outFile, 0, header_end)                   # Add common block to start of each file
+        if compress: CopyRange(infile, outFile, start, stop)
+        else:        SendRange(infile, outFile, start, stop)
+        outFile.write(b"</LesHouchesEvents>\n")                      # End file correctly
+    return outFile.name
+
+def streamIndex(inputfile):
+    # Event spans in the decompressed text of a compressed file, from an
+    # extra pass over it, so planShards can place the cuts like it does for
+    # plain files
+    starts = array.array('d')
+    ends = array.array('d')
+    with LHEReader(inputfile) as reader:
+        for event in reader.events():
+            starts.append(event.offset)
+            ends.append(event.offset+len(event.text))
+        init_start = len(reader.header)
+        init_end = init_start+len(reader.init)
+    return LHEIndex(inputfile, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                    init_start, init_end, os.path.getsize(inputfile), os.path.getmtime(inputfile), False)
+
+def splitStream(inputfile, baseout, compress, nEvt=None, nFiles=None, maxBytes=None):
+    # Compressed input has no byte offsets to hand out, so it is decompressed
+    # once and the events are written out in order. For -k and -s the events
+    # are indexed in an extra pass first and the shards are planned exactly
+    # as for plain files, so -s gives even shards here too.
+    cuts = None
+    if nEvt is None:
+        cuts = set(planShards(streamIndex(inputfile), None, nFiles, maxBytes)[:-1])
+    eventNum = 0
+    fileNum = 0
+    outFile = None
+    with LHEReader(inputfile) as reader:
+        commonBlock = reader.header + reader.init
+        for event in reader.events():
+            if nEvt is not None: newFile = eventNum % nEvt == 0
+            else:                newFile = eventNum in cuts
+            if newFile:
+                if outFile is not None:
+                    outFile.write(b"</LesHouchesEvents>\n")
+                    outFile.close()
+                fileNum += 1
+                outFile = OpenLHEOutput(baseout+"_"+"%05d" % fileNum+".lhe",compress)
+                outFile.write(commonBlock)
+                print "File #:", fileNum
+            eventNum += 1
+            outFile.write(event.text)
+    if outFile is not None:
+        outFile.write(b"</LesHouchesEvents>\n")
+        outFile.close()
+    return eventNum
 
 def main(argv):
 
     inputfile = ''
     nEvt = 10
+    nFiles = None
+    maxBytes = None
+    nJobs = cpu_count()
+    compress = False
 
     # Take user arguments for input file to split and number of events per file
     # Do some basic error checking to see if args are there
     try:
-        opts, args = getopt.getopt(argv,"hi:n:",["ifile=","num="])
+        opts, args = getopt.getopt(argv,"hi:n:k:s:j:z",["ifile=","num=","files=","size=","jobs=","gzip"])
     except getopt.GetoptError:
         printUsage()
         sys.exit(2)
@@ -30,58 +120,63 @@ def main(argv):
         inputfile = arg
       elif opt in ("-n", "--num"):
         nEvt = arg
+      elif opt in ("-k", "--files"):
+        nFiles = int(arg)
+      elif opt in ("-s", "--size"):
+        maxBytes = parseSize(arg)
+      elif opt in ("-j", "--jobs"):
+        nJobs = int(arg)
+      elif opt in ("-z", "--gzip"):
+        compress = True
 
     print 'Input file is', inputfile
-    print 'Number of events per file:', nEvt
+    if nFiles is not None:
+        print 'Number of output files:', nFiles
+        nEvt = None
+    elif maxBytes is not None:
+        print 'Target size per file:', maxBytes, 'bytes'
+        nEvt = None
+    else:
+        print 'Number of events per file:', nEvt
+        nEvt = int(nEvt)
+    if (nEvt is not None and nEvt < 1) or (nFiles is not None and nFiles < 1) or (maxBytes is not None and maxBytes < 1):
+        printUsage()
+        sys.exit(2)
 
     # Root for output files, becomes baseout_fileNum.lhe
-    baseout = inputfile.replace(".lhe","")
+    baseout = os.path.join(os.path.dirname(inputfile), LHEBaseName(inputfile))
+
+    if IsCompressed(inputfile):
+        try:
+            eventNum = splitStream(inputfile, baseout, compress, nEvt, nFiles, maxBytes)
+        except IOError as e:
+            print 'File does not exist!'
+            sys.exit(2)
+        print eventNum, "events in the original LHE file"
+        return
 
-    # Now open the input LHE file (testing to see if it exists), proceed to split up
+    # Index the input LHE file (testing to see if it exists), proceed to split up.
+    # The event boundaries come from the .idx sidecar, so every output file is
+    # known up front and can be written by its own worker as one block copy.
     try:
-        with open(inputfile,"r") as infile: 
-            eventNum = 0  # Count number of events
-            fileNum = 0   # Index for output files. Numbered so baseout_0.lhe has all the init stuff in it (we'll get rid of it at the end)
-
-            outFile = open(baseout+"_"+str(fileNum)+".lhe","w")  # Open first output file to stick all init stuff in
-            commonBlock = '' # Store init info etc
-
-            # Loop over each line
-            while 1:
-                line = infile.readline()
-            
-                if not line:
-                    break
-                else :
-
-                    # Get common block
-                    if ( ( eventNum == 0 ) and not( "<event>" in line ) ):
-                        commonBlock += line
-                    else: pass
-                        
-                    # Decide if this line represents start of a new event    
-                    if( "<event>" in line ):
-                        if ( (eventNum) % int(nEvt) == 0 ):                          # If we've gone through nEvt events, time for a new file. 
-                            outFile.write("</LesHouchesEvents>")                     # End file correctly 
-                            outFile.close()                                          # Close old output lhe file
-                            fileNum += 1
-                            fileNum_str = "%05d" % fileNum
-                            outFile = open(baseout+"_"+fileNum_str+".lhe","w")      # Open new output lhe file with increased index. Should prob catch exceptions...
-                            outFile.write(commonBlock)                              # Add common block to start of each file
-                            print "File #:", fileNum
-                        eventNum += 1
-
-                    outFile.write(line)                    
-            
-            print eventNum, "events in the original LHE file"
-            os.remove(baseout+"_0.lhe") # Leftover with baseout_0.lhe with just init information. Delete this! 
-            
-            infile.close()
-            outFile.close()
-
-    except IOError as e:
+        index = LoadLHEIndex(inputfile)
+    except (IOError, OSError) as e:
        print 'File does not exist!'
        sys.exit(2)
 
+    cuts = planShards(index, nEvt, nFiles, maxBytes)
+    tasks = []
+    for fileNum, (first, last) in enumerate(zip(cuts[:-1], cuts[1:]), 1):
+        fileNum_str = "%05d" % fileNum
+        tasks.append( (inputfile, baseout+"_"+fileNum_str+".lhe", index.init_end,
+                       index.starts[first], index.ends[last-1], compress) )
+
+    # The shards are independent block copies and are written concurrently
+    nShard = dict((task[1], last-first) for task, (first, last) in zip(tasks, zip(cuts[:-1], cuts[1:])))
+    for task, outname in RunParallel(writeChunk, tasks, nJobs):
+        print "Wrote", outname, "({0} events, {1} bytes of events)".format(nShard[task[1]], task[4]-task[3])
+
+    print index.nevents, "events in the original LHE file"
+
 if __name__ == "__main__":
-   main(sys.argv[1:])
\ No newline at end of file
+   main(sys.argv[1:])
@@ -0,0 +1,41 @@
+import glob, sys
+from optparse import OptionParser
+from multiprocessing import cpu_count
+from LHE_Functions import RunParallel, TransformLHE, ScaleScalup, SetCrossSection, RemapPID, MUON_TO_TAU
+
+help_text = """python transformLHE.py [--scalup 0.75] [--xsecup 3.65267E+03 --xerrup 5.00552E+02] [--mu2tau | --pid-map 13:15,-13:-15] [file.events ...] (default is all *.events files)"""
+parser = OptionParser(usage=help_text)
+parser.add_option("--scalup", type="float", dest="scalup", default=None, help="Multiply SCALUP of every event by this factor.")
+parser.add_option("-x", "--xsecup", type="float", dest="xSection", default=None, help="Set XSECUP (pb) in the <init> block.")
+parser.add_option("-e", "--xerrup", type="float", dest="xsErr", default=0.0, help="Set XERRUP (pb) in the <init> block, used together with -x.")
+parser.add_option("--only-unset", action="store_true", dest="onlyUnset", default=False, help="Only set XSECUP/XERRUP where they are still -1.")
+parser.add_option("--pid-map", type="string", dest="pidMap", default="", help="Comma separated old:new particle ID pairs, e.g. 13:15,-13:-15.")
+parser.add_option("--mu2tau", action="store_true", dest="mu2tau", default=False, help="Turn muons and muon neutrinos into taus and tau neutrinos.")
+parser.add_option("-j", "--jobs", type="int", dest="jobs", default=cpu_count(), help="Number of files transformed in parallel (default is the number of cores).")
+(options, args) = parser.parse_args()
+
+# All of the requested transforms are applied to each file in one streaming
+# pass, and the files themselves are spread over a process pool.
+transforms = []
+if options.xSection is not None:
+    transforms.append(SetCrossSection(options.xSection, options.xsErr, options.onlyUnset))
+if options.scalup is not None:
+    transforms.append(ScaleScalup(options.scalup))
+pid_map = {}
+if options.mu2tau: pid_map.update(MUON_TO_TAU)
+for pair in options.pidMap.split(","):
+    if not pair: continue
+    old, new = pair.split(":")
+    pid_map[int(old)] = int(new)
+if pid_map:
+    transforms.append(RemapPID(pid_map))
+
+filenames = args if args else glob.glob("*.events")
+if not transforms or not filenames:
+    print help_text
+    sys.exit(1)
+
+if __name__ == '__main__':
+    tasks = [(fname, transforms) for fname in filenames]
+    for task, (fname, nevents) in RunParallel(TransformLHE, tasks, options.jobs):
+        print "Transformed {0} ({1} events).".format(fname,nevents)